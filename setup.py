@@ -1,4 +1,5 @@
 """Setup/install the package."""
+
 # Always prefer setuptools over distutils
 import codecs
 import os
@@ -37,6 +38,8 @@ setup(
     long_description_content_type="text/markdown",
     keywords="archetypal umitemplatelibrary mongo mongoengine",
     install_requires=install_requires,
+    extras_require={"arrow": ["pyarrow"]},
+    entry_points={"console_scripts": ["umitemplatedb=umitemplatedb.cli:main"]},
     test_suite="tests",
     include_package_data=True,
     classifiers=[
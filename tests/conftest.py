@@ -1,7 +1,11 @@
+import geojson
 import pytest
+from mongoengine import connect, disconnect
 
+from umitemplatedb.core import import_umitemplate
 from umitemplatedb.mongodb_schema import (
     BuildingTemplate,
+    CountryGeometry,
     DaySchedule,
     WeekSchedule,
     YearSchedulePart,
@@ -22,9 +26,26 @@ from umitemplatedb.mongodb_schema import (
     StructureInformation,
     WindowSetting,
     GasLayer,
+    UmiBase,
 )
 
 
+@pytest.fixture(scope="session")
+def db():
+    connect("templatelibrary", host="mongomock://localhost")
+    # connect("templatelibrary")
+    yield
+    disconnect()
+
+
+@pytest.fixture(scope="session")
+def imported(db):
+    UmiBase.drop_collection()
+
+    path = "tests/test_templates/BostonTemplateLibrary.json"
+    import_umitemplate(path)
+
+
 @pytest.fixture()
 def bldg(db, core, struct, window):
     """
@@ -312,3 +333,41 @@ def window(alwaysOn, windowconstruction):
         },
         Name="WindowSetting",
     ).save()
+
+
+def _circle(lon, lat, radius, n=400):
+    import math
+
+    ring = [
+        [
+            lon + radius * math.cos(2 * math.pi * i / n),
+            lat + radius * math.sin(2 * math.pi * i / n),
+        ]
+        for i in range(n)
+    ]
+    return ring + [ring[0]]
+
+
+@pytest.fixture()
+def countries(db):
+    """Replace the geo-countries dataset by two round countries."""
+    features = [
+        geojson.Feature(
+            geometry=geojson.Polygon([_circle(2, 46, 4)]),
+            properties={"ISO_A3": "FRA", "ADMIN": "France"},
+        ),
+        geojson.Feature(
+            geometry=geojson.MultiPolygon(
+                [[_circle(4.5, 50.5, 1)], [_circle(6, 50, 0.01)]]
+            ),
+            properties={"ISO_A3": "BEL", "ADMIN": "Belgium"},
+        ),
+    ]
+    previous = BuildingTemplate._geo_countries
+    BuildingTemplate._geo_countries = features
+    CountryGeometry.drop_collection()
+    yield features
+    for bldg in BuildingTemplate.objects(Name__startswith="Geo "):
+        bldg.delete()
+    BuildingTemplate._geo_countries = previous
+    CountryGeometry.drop_collection()
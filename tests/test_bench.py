@@ -0,0 +1,8 @@
+from umitemplatedb.bench import bench_to_template, format_report
+
+
+def test_bench_to_template(imported):
+    results = bench_to_template(repeat=1)
+
+    assert results["no_idf"]["per_template"] > 0
+    assert "no_idf" in format_report(results)
@@ -0,0 +1,66 @@
+from umitemplatedb.cache import DocumentCache, document_cache
+from umitemplatedb.mongodb_schema import BuildingTemplate, OpaqueMaterial
+
+
+def test_lru_eviction():
+    cache = DocumentCache(maxsize=2)
+    cache.put_many([{"_id": "a"}, {"_id": "b"}])
+    assert cache.get_many(["a"], loader=list)  # "a" is now most recently used
+    cache.put_many([{"_id": "c"}])
+
+    assert "a" in cache and "c" in cache and "b" not in cache
+    assert cache.stats()["evictions"] == 1
+
+
+def test_ttl():
+    cache = DocumentCache(ttl=0)
+    cache.put_many([{"_id": "a"}])
+    assert cache.get_many(["a"], loader=lambda keys: []) == []
+
+
+def test_prefetch_uses_cache(imported):
+    document_cache.clear()
+    for bldg in BuildingTemplate.objects():
+        bldg.prefetch()
+        # No query is needed to walk the graph once it is prefetched
+        schedule = bldg.Core.Loads.OccupancySchedule
+        assert len(schedule.Parts[0].Schedule.Days[0].Values) == 24
+    # Components shared by several templates are only fetched once
+    assert document_cache.stats()["hits"] > 0
+
+
+def test_dereference_uses_cache(imported):
+    document_cache.clear()
+    for bldg in BuildingTemplate.objects():
+        # Attribute access dereferences through the cache
+        schedule = bldg.Core.Loads.OccupancySchedule
+        assert len(schedule.Parts[0].Schedule.Days[0].Values) == 24
+    assert document_cache.stats()["hits"] > 0
+
+    bldg = BuildingTemplate.objects().first()
+    son = dict(document_cache.get_many([bldg.Core.Loads.key])[0], Name="Cached")
+    document_cache.put_many([son])
+    try:
+        assert BuildingTemplate.objects.get(key=bldg.key).Core.Loads.Name == "Cached"
+    finally:
+        document_cache.invalidate(son["_id"])
+
+
+def test_save_invalidates(imported):
+    material = OpaqueMaterial.objects().first()
+    document_cache.get_many([material.key])
+    assert material.key in document_cache
+
+    material.save()
+    assert material.key not in document_cache
+
+
+def test_store_put_many_invalidates(imported):
+    from umitemplatedb.storage import MongoStore
+
+    material = OpaqueMaterial.objects().first()
+    son = document_cache.get_many([material.key])[0]
+    assert material.key in document_cache
+
+    MongoStore().put_many([dict(son)])
+    assert material.key not in document_cache
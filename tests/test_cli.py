@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from umitemplatedb.cli import main
+
+HOST = "mongomock://localhost"
+
+
+def test_cli_query(imported, capsys):
+    main(["--host", HOST, "query", "--json", "--filter", "Name__in=B_Off_0,B_Res_0"])
+    entries = json.loads(capsys.readouterr().out)
+    assert {entry["Name"] for entry in entries} <= {"B_Off_0", "B_Res_0"}
+
+
+def test_cli_export_profile(imported, tmp_path, capsys):
+    output = tmp_path / "library.json"
+    main(["--host", HOST, "--profile", "export", "--jobs", "2", "-o", str(output)])
+
+    assert json.loads(output.read_text())["BuildingTemplates"]
+    report = json.loads(capsys.readouterr().err)
+    assert {"cli.export", "export.convert", "export.write"} <= set(report["phases"])
+
+
+def test_cli_invalid_filter(imported, capsys):
+    for value in ("Country:FRA", "Foo=1"):
+        with pytest.raises(SystemExit) as e:
+            main(["--host", HOST, "query", "--filter", value])
+        assert e.value.code == 2
+        assert "error:" in capsys.readouterr().err
+
+
+def test_cli_options_where_used():
+    with pytest.raises(SystemExit):
+        main(["--host", HOST, "query", "--jobs", "4"])
+    with pytest.raises(SystemExit):
+        main(["--host", HOST, "bench", "--batch-size", "10"])
@@ -0,0 +1,26 @@
+import pytest
+
+from umitemplatedb.columnar import export_tables
+from umitemplatedb.mongodb_schema import BuildingTemplate, OpaqueMaterial
+
+
+def test_export_tables_arrow(imported):
+    pytest.importorskip("pyarrow")
+    tables = export_tables()
+
+    assert tables["BuildingTemplate"].num_rows == BuildingTemplate.objects().count()
+    assert tables["OpaqueMaterial"].num_rows == OpaqueMaterial.objects().count()
+    # Embedded lists are flattened into child tables keyed on the parent
+    layers = tables["OpaqueConstruction.Layers"].to_pydict()
+    assert set(layers["parent"]) <= set(tables["OpaqueConstruction"]["key"].to_pylist())
+    assert set(layers["Material"]) <= set(OpaqueMaterial.objects().distinct("key"))
+    assert tables["WeekSchedule.Days"].num_rows == 7 * tables["WeekSchedule"].num_rows
+
+
+def test_export_tables_pushdown(imported):
+    bldg = BuildingTemplate.objects().first()
+    tables = export_tables(backend="numpy", Name=bldg.Name)
+
+    assert list(tables["BuildingTemplate"]["key"]) == [bldg.key]
+    # Only the components reachable from the selected template are exported
+    assert set(tables["ZoneDefinition"]["key"]) == {bldg.Core.key, bldg.Perimeter.key}
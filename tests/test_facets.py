@@ -0,0 +1,43 @@
+from umitemplatedb.cli import main
+from umitemplatedb.facets import facets, rebuild_facets
+from umitemplatedb.mongodb_schema import BuildingTemplate
+
+
+def test_facets_maintained(imported, core, struct, window):
+    rebuild_facets()
+    before = facets()
+
+    bldg = BuildingTemplate(
+        Name="Facet Template",
+        Core=core,
+        Perimeter=core,
+        Structure=struct,
+        Windows=window,
+        Authors=["Doe", "Roe"],
+        YearFrom=1985,
+        YearTo=1990,
+    ).save()
+    after = facets()
+    assert after["Authors"]["Doe"] == before["Authors"].get("Doe", 0) + 1
+    assert after["YearFrom"]["1980-1989"] == before["YearFrom"].get("1980-1989", 0) + 1
+    assert after["YearTo"]["1990-1999"] == before["YearTo"].get("1990-1999", 0) + 1
+
+    bldg.Authors = ["Doe"]
+    bldg.save()
+    assert facets("Authors")["Authors"].get("Roe", 0) == before["Authors"].get("Roe", 0)
+
+    # Incremental counts match a full recount
+    incremental = facets()
+    rebuild_facets()
+    assert facets() == incremental
+
+    bldg.delete()
+    assert facets() == before
+
+
+def test_cli_facets(imported, capsys):
+    main(["--host", "mongomock://localhost", "index"])
+    capsys.readouterr()
+    main(["--host", "mongomock://localhost", "facets", "Category"])
+    out = capsys.readouterr().out
+    assert out.startswith("Category:")
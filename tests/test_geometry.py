@@ -0,0 +1,95 @@
+import pytest
+
+from umitemplatedb.cli import main
+from umitemplatedb.geometry import migrate_country_geometries
+from umitemplatedb.mongodb_schema import BuildingTemplate, CountryGeometry
+
+
+def test_country_geometry_is_shared(countries, core, struct, window):
+    bldgs = [
+        BuildingTemplate(
+            Name=f"Geo Template {i}",
+            Core=core,
+            Perimeter=core,
+            Structure=struct,
+            Windows=window,
+            Country=["FRA", "BEL"],
+        ).save()
+        for i in range(2)
+    ]
+    assert CountryGeometry.objects.count() == 2
+    son = BuildingTemplate._get_collection().find_one({"_id": bldgs[0].key})
+    assert "Polygon" not in son and "MultiPolygon" not in son
+    assert son["CountryGeometries"] == ["FRA", "BEL"]
+    assert son["BoundingBox"] == pytest.approx([-2, 42, 6.01, 51.5])
+    # The tiny island of BEL is simplified away
+    assert len(son["Footprint"]["coordinates"]) == 2
+    assert len(son["Footprint"]["coordinates"][0][0]) < 400
+
+    bldg = BuildingTemplate.objects.get(key=bldgs[1].key)
+    assert len(bldg.get_geometry()["coordinates"]) == 3
+    assert bldg.to_template().Name == "Geo Template 1"
+
+
+def test_migrate_country_geometries(countries, core, struct, window):
+    bldg = BuildingTemplate(
+        Name="Geo Legacy",
+        Core=core,
+        Perimeter=core,
+        Structure=struct,
+        Windows=window,
+        Country=["FRA"],
+    ).save()
+    # Store the template as it was before: with a copy of the country geometry
+    collection = BuildingTemplate._get_collection()
+    collection.update_one(
+        {"_id": bldg.key},
+        {
+            "$set": {"Polygon": countries[0]["geometry"]},
+            "$unset": {"CountryGeometries": "", "BoundingBox": "", "Footprint": ""},
+        },
+    )
+    CountryGeometry.drop_collection()
+
+    main(["--host", "mongomock://localhost", "migrate"])
+
+    son = collection.find_one({"_id": bldg.key})
+    assert "Polygon" not in son
+    assert son["CountryGeometries"] == ["FRA"]
+    assert son["BoundingBox"] == pytest.approx([-2, 42, 6, 50])
+    assert CountryGeometry.objects.get(ISO3_CODE="FRA").geometry["coordinates"] == [
+        countries[0]["geometry"]["coordinates"]
+    ]
+
+    # Running the migration again changes nothing
+    modified = collection.find_one({"_id": bldg.key})["DateModified"]
+    assert migrate_country_geometries() == 0
+    assert collection.find_one({"_id": bldg.key})["DateModified"] == modified
+
+
+def test_migrate_multi_country_geometries(countries, core, struct, window):
+    bldg = BuildingTemplate(
+        Name="Geo Legacy Multi",
+        Core=core,
+        Perimeter=core,
+        Structure=struct,
+        Windows=window,
+        Country=["FRA", "BEL"],
+    ).save()
+    # The copy of the geometry of BEL, the second country, is a copy too
+    collection = BuildingTemplate._get_collection()
+    collection.update_one(
+        {"_id": bldg.key},
+        {
+            "$set": {"MultiPolygon": countries[1]["geometry"]},
+            "$unset": {"CountryGeometries": "", "BoundingBox": "", "Footprint": ""},
+        },
+    )
+    CountryGeometry.drop_collection()
+
+    main(["--host", "mongomock://localhost", "migrate"])
+
+    son = collection.find_one({"_id": bldg.key})
+    assert "MultiPolygon" not in son
+    assert son["CountryGeometries"] == ["FRA", "BEL"]
+    assert son["BoundingBox"] == pytest.approx([-2, 42, 6.01, 51.5])
@@ -0,0 +1,111 @@
+import json
+
+import pytest
+
+from umitemplatedb.cli import main
+from umitemplatedb.integrity import check_integrity, repair
+from umitemplatedb.mongodb_schema import (
+    MaterialLayer,
+    OpaqueConstruction,
+    OpaqueMaterial,
+    Tombstone,
+    UmiBase,
+)
+
+
+def test_check_and_repair(imported, capsys):
+    report = check_integrity()
+    assert report["documents"] == UmiBase.objects().count()
+    assert not report["misfiled"]
+    assert not report["mismatched"]
+
+    collection = UmiBase._get_collection()
+    OpaqueMaterial(Name="Integrity Material", Aliases=["Integrity Old"]).save()
+    orphan = OpaqueMaterial(Name="Integrity Orphan").save()
+    used = OpaqueMaterial(Name="Integrity Used").save()
+    construction = OpaqueConstruction(Name="Integrity Construction").save()
+    layer = {"_cls": "MaterialLayer", "Thickness": 0.1}
+    collection.update_one(
+        {"_id": construction.key},
+        {
+            "$set": {
+                "Layers": [
+                    dict(layer, Material="OpaqueMaterial, Integrity Old"),
+                    dict(layer, Material="OpaqueMaterial, Integrity Missing"),
+                    dict(layer, Material="OpaqueConstruction, Integrity Construction"),
+                ]
+            }
+        },
+    )
+    collection.insert_one(
+        {"_id": "OpaqueMaterial, Integrity Misfiled", "_cls": "UmiBase.GlazingMaterial"}
+    )
+    try:
+        report = check_integrity()
+        assert report["dangling"] == [
+            (construction.key, "Layers.0.Material", "OpaqueMaterial, Integrity Old"),
+            (
+                construction.key,
+                "Layers.1.Material",
+                "OpaqueMaterial, Integrity Missing",
+            ),
+        ]
+        assert report["mismatched"] == [
+            (
+                construction.key,
+                "Layers.2.Material",
+                construction.key,
+                "Material",
+                "OpaqueConstruction",
+            )
+        ]
+        assert [key for key, _, _ in report["misfiled"]] == [
+            "OpaqueMaterial, Integrity Misfiled"
+        ]
+        assert {orphan.key, construction.key} <= set(report["orphans"])
+        assert main(["--host", "mongomock://localhost", "check", "--json"]) == 1
+        assert json.loads(capsys.readouterr().out)["dangling"]
+
+        # Only delete the orphans of this test: other tests use the rest
+        report["orphans"] = [orphan.key, used.key]
+        with pytest.raises(ValueError):
+            repair(report, gc=True)  # misfiled documents are fixed first
+        collection.delete_one({"_id": "OpaqueMaterial, Integrity Misfiled"})
+        report["misfiled"] = []
+        # An orphan used since the scan, e.g. by an import, is kept
+        layers = [MaterialLayer(Material=used, Thickness=0.1)]
+        OpaqueConstruction(Name="Integrity Late", Layers=layers).save()
+        repaired = repair(report, gc=True)
+        assert repaired["repointed"] == [
+            (
+                construction.key,
+                "Layers.0.Material",
+                "OpaqueMaterial, Integrity Material",
+            )
+        ]
+        assert repaired["deleted"] == [orphan.key]
+        stored = collection.find_one({"_id": construction.key})
+        assert stored["DateModified"] > construction.DateModified
+        assert not OpaqueMaterial.objects(key=orphan.key)
+        assert OpaqueMaterial.objects(key=used.key)
+        assert Tombstone.objects(key=orphan.key)
+        dangling = check_integrity()["dangling"]
+        assert [target for _, _, target in dangling] == [
+            "OpaqueMaterial, Integrity Missing"
+        ]
+    finally:
+        collection.delete_many({"Name": {"$regex": "^Integrity "}})
+        collection.delete_one({"_id": "OpaqueMaterial, Integrity Misfiled"})
+
+
+def test_unknown_class_keeps_references(imported):
+    before = check_integrity()
+    collection = UmiBase._get_collection()
+    zone = collection.find_one({"_cls": "UmiBase.ZoneDefinition"})
+    collection.update_one({"_id": zone["_id"]}, {"$set": {"_cls": "UmiBase.Zone"}})
+    try:
+        report = check_integrity()
+        assert [key for key, _, _ in report["misfiled"]] == [zone["_id"]]
+        assert report["orphans"] == before["orphans"]
+    finally:
+        collection.update_one({"_id": zone["_id"]}, {"$set": {"_cls": zone["_cls"]}})
@@ -0,0 +1,59 @@
+import pytest
+
+from umitemplatedb.facets import rebuild_facets
+from umitemplatedb.loadtest import format_report, percentile, run, synthesize
+from umitemplatedb.mongodb_schema import BuildingTemplate, CountryGeometry
+from umitemplatedb.references import rebuild_index
+from umitemplatedb.storage import MongoStore
+
+
+@pytest.fixture()
+def synthetic(imported):
+    keys = synthesize(20)
+    yield keys
+    MongoStore().delete_many(keys)
+    rebuild_index()
+    rebuild_facets()
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([], 50) is None
+
+
+def test_run(synthetic):
+    assert BuildingTemplate.objects(key__in=synthetic).count() == 20
+    report = run(
+        {"catalog": 3, "facets": 1, "fetch": 1, "export": 1, "geo": 1},
+        clients=4,
+        requests=10,
+    )
+    assert report["total"] + report["operations"]["geo"]["errors"] == 40
+    for name in ("catalog", "facets", "fetch", "export"):
+        entry = report["operations"][name]
+        assert entry["errors"] == 0
+        if entry["count"]:
+            assert entry["p50"] <= entry["p95"] <= entry["p99"] <= entry["max"]
+    assert "ops/s" in format_report(report)
+
+    with pytest.raises(ValueError):
+        run({"drop_database": 1})
+
+
+def test_synthetic_geometry(imported, countries):
+    keys = synthesize(20, seed=1)
+    try:
+        for bldg in BuildingTemplate.objects(key__in=keys):
+            code = bldg.Country[0]
+            if code in ("FRA", "BEL"):
+                assert [c.pk for c in bldg.CountryGeometries] == [code]
+                box = CountryGeometry.objects.get(ISO3_CODE=code).BoundingBox
+                assert bldg.BoundingBox == box
+            else:
+                assert not bldg.CountryGeometries and not bldg.BoundingBox
+    finally:
+        MongoStore().delete_many(keys)
+        rebuild_index()
+        rebuild_facets()
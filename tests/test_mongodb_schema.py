@@ -1,11 +1,16 @@
 import json
+import os
 
 import pytest
 import shapely.geometry
 from archetypal import UmiTemplateLibrary
-from mongoengine import connect, disconnect, Q
+from mongoengine import Q
 
-from umitemplatedb.core import import_umitemplate
+from umitemplatedb.core import (
+    export_templates,
+    import_umitemplate,
+    template_filename,
+)
 from umitemplatedb.mongodb_schema import *
 
 
@@ -30,8 +35,8 @@ def test_filter_by_geo(bldg):
     """Shows how to filter database by geolocation.
 
     Hint:
-        This is the logic: [building if <building.Polygon intersects pt> for
-        building in BuildingTemplates]
+        This is the logic: [building if <country geometry of building
+        intersects pt> for building in BuildingTemplates]
 
         We would create the geoquery this way: First create a geojson-like dict
         using :meth:`shapely.geometry.mapping`. Then pass this pt to the
@@ -50,7 +55,7 @@ def test_filter_by_geo(bldg):
     # First, a sanity check. We build a pt and use
     # the :meth:`intersects` method.
     pt = Point(2, 46)  # Point inside France
-    polygon = json.dumps(bldg.Polygon or bldg.MultiPolygon)
+    polygon = json.dumps(bldg.get_geometry())
     # Convert to geojson.geometry.Polygon
     g1 = geojson.loads(polygon)
     g2 = shapely.geometry.shape(g1)
@@ -59,8 +64,11 @@ def test_filter_by_geo(bldg):
 
     # Second, the actual filter with point pt
     ptj = shapely.geometry.mapping(pt)
+    codes = CountryGeometry.objects(geometry__geo_intersects=ptj).scalar("ISO3_CODE")
     retreived_bldgs = BuildingTemplate.objects(
-        Q(Polygon__geo_intersects=ptj) | Q(MultiPolygon__geo_intersects=ptj)
+        Q(CountryGeometries__in=list(codes))
+        | Q(Polygon__geo_intersects=ptj)
+        | Q(MultiPolygon__geo_intersects=ptj)
     ).all()
     assert all((bld.Country == "FRA" for bld in retreived_bldgs))
 
@@ -93,17 +101,96 @@ def test_serialize_templatelist(bldg, window, struct, core):
     print(lib.to_json())
 
 
-@pytest.fixture(scope="session")
-def db():
-    connect("templatelibrary", host="mongomock://localhost")
-    # connect("templatelibrary")
-    yield
-    disconnect()
-
-
-@pytest.fixture(scope="session")
-def imported(db):
-    UmiBase.drop_collection()
-
+def test_import_resume(db):
     path = "tests/test_templates/BostonTemplateLibrary.json"
-    import_umitemplate(path)
+    seen = []
+
+    def fail_after_two(state):
+        seen.append(state.current)
+        if state.done == 2:
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        import_umitemplate(path, chunk_size=1, resume=False, progress=fail_after_two)
+
+    state = import_umitemplate(path, chunk_size=1)
+    assert state.skipped == 2
+    assert state.done == state.total
+    assert ImportCheckpoint.objects().get(filename=path).finished
+
+    # A finished import is not resumed
+    state = import_umitemplate(path, chunk_size=1)
+    assert state.skipped == 0
+    assert state.components > 0
+
+    # Templates deleted since the interruption are imported again
+    with pytest.raises(KeyboardInterrupt):
+        import_umitemplate(path, chunk_size=1, resume=False, progress=fail_after_two)
+    deleted = BuildingTemplate.objects.get(Name=seen[-1])
+    deleted.delete()
+    state = import_umitemplate(path, chunk_size=1)
+    assert state.skipped == 1
+    assert BuildingTemplate.objects(Name=deleted.Name).count() == 1
+
+
+@pytest.fixture()
+def content_addressed(db):
+    UmiBase.content_addressed = True
+    yield
+    UmiBase.content_addressed = False
+
+
+def test_content_addressed_key(content_addressed):
+    brick = OpaqueMaterial(Name="Brick", Conductivity=0.8).save()
+    same = OpaqueMaterial(Name="Ziegel", Conductivity=0.8).save()
+    other = OpaqueMaterial(Name="Brick", Conductivity=1.2).save()
+
+    # Identical content is stored once, under its first name
+    assert brick.key == same.key
+    stored = OpaqueMaterial.objects.get(key=brick.key)
+    assert stored.Name == "Brick" and stored.Aliases == ["Ziegel"]
+    assert OpaqueMaterial.objects(Aliases="Ziegel").first().key == brick.key
+
+    # Same name with different content no longer overwrites
+    assert other.key != brick.key
+    assert OpaqueMaterial.objects.get(key=other.key).Conductivity == 1.2
+
+    # Saving again under the first name keeps the aliases
+    OpaqueMaterial(Name="Brick", Conductivity=0.8).save()
+    assert OpaqueMaterial.objects.get(key=brick.key).Aliases == ["Ziegel"]
+
+    # Category is descriptive
+    masonry = OpaqueMaterial(Name="Brick", Category="Masonry", Conductivity=0.8)
+    assert masonry.save().key == brick.key
+
+    # Editing a stored component would leave its referrers on the old content
+    stored.Conductivity = 0.9
+    with pytest.raises(ValueError):
+        stored.save()
+    stored.key = None
+    copy = stored.save()
+    assert copy.key not in (brick.key, other.key)
+    assert OpaqueMaterial.objects.get(key=copy.key).Name == "Brick"
+    assert OpaqueMaterial.objects.get(key=brick.key).Conductivity == 0.8
+
+
+def test_export_templates(imported, tmp_path):
+    lib = export_templates(jobs=2)
+
+    assert len(lib.BuildingTemplates) == BuildingTemplate.objects().count()
+    # Components converted by both workers appear once in the merged library
+    names = [s.Name for s in lib.YearSchedules]
+    assert len(names) == len(set(names))
+    assert json.loads(lib.to_json())["BuildingTemplates"]
+
+    files = export_templates(jobs=2, path=tmp_path)
+    assert len(files) == BuildingTemplate.objects().count()
+    assert all(os.path.dirname(f) == str(tmp_path) for f in files)
+
+
+def test_template_filename():
+    assert template_filename("B_Off_0") == "B_Off_0.json"
+    assert "/" not in template_filename("Office 1980/2000")
+    assert template_filename("a/b") != template_filename("a_b")
+    assert template_filename("..").endswith(".json")
+    assert "/" not in template_filename("../etc")
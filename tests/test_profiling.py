@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+from umitemplatedb.core import import_umitemplate
+from umitemplatedb.profiling import Profiler, profiler
+
+
+@pytest.fixture
+def profiling():
+    profiler.reset()
+    profiler.enable(memory=True)
+    yield profiler
+    profiler.disable()
+    profiler.reset()
+
+
+def test_disabled_phase_is_shared_noop():
+    assert not profiler.enabled
+    assert profiler.phase("export.fetch") is profiler.phase("export.convert")
+
+
+def test_profile_import(imported, profiling, tmp_path):
+    state = import_umitemplate(
+        "tests/test_templates/BostonTemplateLibrary.json",
+        resume=False,
+        progress=lambda s: None,
+    )
+    phases = profiling.report()["phases"]
+    assert phases["import.open"]["calls"] == 1
+    assert phases["import.convert"]["calls"] == state.total
+    assert phases["save.geometry"]["calls"] == state.total
+    assert phases["save.write"]["calls"] >= phases["save.geometry"]["calls"]
+    assert "allocated" in phases["import.open"]
+
+    profiling.dump(tmp_path / "profile.json")
+    report = json.loads((tmp_path / "profile.json").read_text())
+    assert report["peak_memory"] > 0
+
+
+def test_profiled_decorator():
+    local = Profiler()
+
+    @local.profiled("square")
+    def square(x):
+        return x * x
+
+    assert square(2) == 4
+    assert local.report()["phases"] == {}
+    local.enable()
+    square(3)
+    square(4)
+    assert local.report()["phases"]["square"]["calls"] == 2
+
+
+def test_disable_keeps_caller_tracing():
+    import tracemalloc
+
+    tracemalloc.start()
+    try:
+        local = Profiler()
+        local.enable(memory=True)
+        local.disable()
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+    local.enable(memory=True)
+    local.disable()
+    assert not tracemalloc.is_tracing()
@@ -0,0 +1,62 @@
+from umitemplatedb.mongodb_schema import (
+    BuildingTemplate,
+    ReferenceIndex,
+    YearSchedule,
+    ZoneLoad,
+)
+from umitemplatedb.references import (
+    impact,
+    rebuild_index,
+    referrers,
+    templates_using,
+)
+
+
+def test_index_maintained_on_import(imported):
+    schedule = YearSchedule.objects().first()
+    templates = set(templates_using(schedule.key))
+
+    expected = {
+        bldg.key
+        for bldg in BuildingTemplate.objects()
+        if schedule.key in {s.key for s in _year_schedules(bldg)}
+    }
+    assert expected <= templates
+    assert referrers(schedule.key)
+
+
+def test_rebuild_index(imported):
+    def entries():
+        return {
+            e.key: (set(e.referrers), set(e.templates))
+            for e in ReferenceIndex.objects(referrers__not__size=0)
+        }
+
+    before = entries()
+    rebuild_index()
+    assert entries() == before
+
+
+def test_index_updated_on_save_and_delete(imported):
+    loads = ZoneLoad.objects().first()
+    old = loads.OccupancySchedule
+    new = YearSchedule(Name="New Occupancy", Parts=old.Parts).save()
+
+    loads.OccupancySchedule = new
+    loads.save()
+    assert loads.key in referrers(new.key)
+    assert loads.key not in referrers(old.key)
+    assert set(templates_using(loads.key)) <= set(templates_using(new.key))
+
+    loads.OccupancySchedule = old
+    loads.save()
+    assert impact(new.key) == {"referrers": [], "templates": []}
+    new.delete()
+    assert ReferenceIndex.objects(key=new.key).count() == 0
+
+
+def _year_schedules(bldg):
+    for zone in (bldg.Core, bldg.Perimeter):
+        yield zone.Loads.OccupancySchedule
+        yield zone.Loads.EquipmentAvailabilitySchedule
+        yield zone.Loads.LightsAvailabilitySchedule
@@ -0,0 +1,74 @@
+import json
+import threading
+from datetime import datetime
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+from umitemplatedb.mongodb_schema import BuildingTemplate
+from umitemplatedb.server import make_server
+
+
+@pytest.fixture()
+def url(imported):
+    server = make_server(port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_catalog(url):
+    bldg = BuildingTemplate.objects().first()
+    with urlopen(f"{url}/templates?Name={bldg.Name}") as response:
+        entries = json.loads(response.read())
+    assert [entry["key"] for entry in entries] == [bldg.key]
+
+    for query in ("NotAField=1", "Name__foo=1"):
+        with pytest.raises(HTTPError) as e:
+            urlopen(f"{url}/templates?{query}")
+        assert e.value.code == 400
+
+
+def test_template_etag(url):
+    bldg = BuildingTemplate.objects().first()
+    template_url = f"{url}/templates/{bldg.key}.json".replace(" ", "%20")
+    with urlopen(template_url) as response:
+        etag = response.headers["ETag"]
+        lib = json.loads(response.read())
+    assert [t["Name"] for t in lib["BuildingTemplates"]] == [bldg.Name]
+
+    with pytest.raises(HTTPError) as e:
+        urlopen(Request(template_url, headers={"If-None-Match": etag}))
+    assert e.value.code == 304
+
+    # A write of another process changes the ETag at once
+    BuildingTemplate._get_collection().update_one(
+        {"_id": bldg.key},
+        {"$set": {"Comments": "Updated elsewhere", "DateModified": datetime.utcnow()}},
+    )
+    request = Request(template_url, headers={"If-None-Match": etag})
+    with urlopen(request) as response:
+        assert response.headers["ETag"] != etag
+        lib = json.loads(response.read())
+    assert lib["BuildingTemplates"][0]["Comments"] == "Updated elsewhere"
+
+
+def test_export_stream(url):
+    with urlopen(f"{url}/export") as response:
+        lines = response.read().splitlines()
+    assert len(lines) == BuildingTemplate.objects().count()
+    assert all(json.loads(line)["BuildingTemplates"] for line in lines)
+
+
+def test_facets(url):
+    from umitemplatedb.facets import facets
+
+    with urlopen(f"{url}/facets?names=Category") as response:
+        assert json.loads(response.read()) == facets("Category")
+
+    with pytest.raises(HTTPError) as e:
+        urlopen(f"{url}/facets?names=NotAFacet")
+    assert e.value.code == 400
@@ -0,0 +1,94 @@
+import pytest
+
+from umitemplatedb.mongodb_schema import BuildingTemplate, CountryGeometry
+from umitemplatedb.storage import MongoStore, SQLiteStore, _Store
+
+
+@pytest.fixture()
+def store(imported, tmp_path):
+    with SQLiteStore(tmp_path / "templates.db") as store:
+        store.import_from(MongoStore())
+        yield store
+
+
+def test_sqlite_find_templates(store):
+    names = {son["Name"] for son in store.find_templates()}
+    assert names == set(BuildingTemplate.objects().distinct("Name"))
+
+    bldg = BuildingTemplate.objects().first()
+    (son,) = store.find_templates(Name=bldg.Name)
+    assert son["_id"] == bldg.key
+    assert store.find_templates(Name__in=["does not exist"]) == []
+
+
+def test_sqlite_get_template(store):
+    bldg = BuildingTemplate.objects().first()
+    offline = store.get_template(bldg.key)
+
+    assert offline.key == bldg.key
+    assert offline.Core.Loads.OccupancySchedule.Parts[0].Schedule.Days[0].Values == (
+        bldg.Core.Loads.OccupancySchedule.Parts[0].Schedule.Days[0].Values
+    )
+    assert offline.Structure.MassRatios[0].Material.key == (
+        bldg.Structure.MassRatios[0].Material.key
+    )
+
+
+def test_sqlite_readonly(store):
+    store.close()
+    with SQLiteStore(store.path, readonly=True) as readonly:
+        assert readonly.find_templates()
+        with pytest.raises(Exception):
+            readonly.put_many(readonly.find_templates())
+
+
+def test_incomplete_store():
+    class Incomplete(_Store):
+        def get_many(self, keys):
+            return []
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_mongo_meta(db):
+    store = MongoStore()
+    assert store.get_meta("test_token", "none") == "none"
+    store.set_meta("test_token", "2026-01-01T00:00:00")
+    assert store.get_meta("test_token") == "2026-01-01T00:00:00"
+
+
+def test_sqlite_put_offline(tmp_path, monkeypatch, core, struct, window):
+    def offline(code):
+        raise AssertionError("the geo-countries dataset was loaded")
+
+    monkeypatch.setattr(CountryGeometry, "from_country", offline)
+    with SQLiteStore(tmp_path / "templates.db") as store:
+        bldg = BuildingTemplate(
+            Name="Offline Template",
+            Core=core,
+            Perimeter=core,
+            Structure=struct,
+            Windows=window,
+            Country=["FRA"],
+        )
+        store.put(bldg)
+        (son,) = store.find_templates(Name="Offline Template")
+        assert son["Country"] == ["FRA"] and not son.get("CountryGeometries")
+
+
+def test_sqlite_export_offline(store):
+    from mongoengine import connect, disconnect
+    from mongoengine.connection import get_connection
+
+    bldg = BuildingTemplate.objects().first()
+    memory = get_connection()._store  # mongomock data, kept across connections
+    disconnect()
+    try:
+        template = store.get_template(bldg.key).to_template()
+    finally:
+        connect("templatelibrary", host="mongomock://localhost", _store=memory)
+    assert template.Name == bldg.Name
+    assert template.Core.Loads.OccupancySchedule.Name == (
+        bldg.Core.Loads.OccupancySchedule.Name
+    )
@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta
+
+from bson import json_util
+
+from umitemplatedb.mongodb_schema import BuildingTemplate, DaySchedule, UmiBase
+from umitemplatedb.storage import MongoStore, SQLiteStore
+from umitemplatedb.sync import TOKEN_KEY, apply_changes, changes_since, sync
+
+NO_LAG = timedelta(0)
+
+
+def test_sync_mirror(imported, tmp_path):
+    with SQLiteStore(tmp_path / "mirror.db") as mirror:
+        changes = sync(mirror, lag=NO_LAG)
+        assert len(changes["documents"]) == UmiBase.objects.count()
+        assert mirror.get_meta(TOKEN_KEY) == changes["token"]
+
+        day = DaySchedule(Name="Sync Day", Values=[0.5] * 24).save()
+        changes = sync(mirror, lag=NO_LAG)
+        assert [son["_id"] for son in changes["documents"]] == [day.key]
+        assert mirror.get_many([day.key])
+
+        day.delete()
+        changes = sync(mirror, lag=NO_LAG)
+        assert changes["documents"] == []
+        assert changes["deleted"] == [day.key]
+        assert mirror.get_many([day.key]) == []
+
+
+def test_filtered_changes(imported, tmp_path):
+    office = BuildingTemplate.objects.get(Name="B_Off_0")
+    other = BuildingTemplate.objects.get(Name="B_Ret_0")
+    changes = changes_since(lag=NO_LAG, Name="B_Off_0")
+    assert changes["templates"] == [office.key]
+    assert office.Core.Loads.key in {son["_id"] for son in changes["documents"]}
+
+    token = changes["token"]
+    used, unused = office.Core.Loads, other.Core.Loads
+    assert used.key != unused.key
+    used.save()
+    unused.save()
+    changes = changes_since(token, lag=NO_LAG, Name="B_Off_0")
+    assert [son["_id"] for son in changes["documents"]] == [used.key]
+
+    # Changes sent over HTTP are decoded with bson.json_util
+    with SQLiteStore(tmp_path / "mirror.db") as mirror:
+        apply_changes(mirror, json_util.loads(json_util.dumps(changes)))
+        (son,) = mirror.get_many([used.key])
+        assert isinstance(son["DateModified"], datetime)
+
+
+def test_bulk_deletes_leave_tombstones(imported):
+    days = [
+        DaySchedule(Name=f"Sync Bulk {i}", Values=[0.0] * 24).save() for i in range(3)
+    ]
+    MongoStore().delete_many([days[0].key])
+    assert DaySchedule.objects(Name__startswith="Sync Bulk ").delete() == 2
+    changes = changes_since(datetime.utcnow() - timedelta(minutes=1), lag=NO_LAG)
+    assert {day.key for day in days} <= set(changes["deleted"])
@@ -0,0 +1,5 @@
+import sys
+
+from umitemplatedb.cli import main
+
+sys.exit(main())
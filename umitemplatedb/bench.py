@@ -0,0 +1,93 @@
+"""Benchmarks of the export path.
+
+Example:
+    >>> from umitemplatedb.bench import bench_to_template, format_report
+    >>> print(format_report(bench_to_template(repeat=3)))
+"""
+import logging
+import time
+
+from umitemplatedb.cache import document_cache
+from umitemplatedb.mongodb_schema import BuildingTemplate
+
+log = logging.getLogger(__name__)
+
+
+def _new_idf():
+    from archetypal import IDF
+
+    return IDF()
+
+
+def bench_to_template(bldgs=None, repeat=3):
+    """Measure the per-template cost of :meth:`BuildingTemplate.to_template`.
+
+    Three modes are compared:
+
+    - "idf_per_template": a new IDF is created for every template, which is
+      what `to_template` used to do when no `idf` was given;
+    - "shared_idf": one IDF is created for the whole session;
+    - "no_idf": no IDF is created (the default).
+
+    The document cache is warmed up first so that only the conversion is
+    measured. Creating an IDF requires EnergyPlus: modes that fail are reported
+    with their error.
+
+    Args:
+        bldgs (list of BuildingTemplate): The templates to convert. Defaults to
+            all the BuildingTemplates of the database.
+        repeat (int): Number of conversions of each template.
+
+    Returns:
+        dict: For each mode, a dict with "per_template" and "total" seconds, or
+            "error" if the mode could not run.
+    """
+    if bldgs is None:
+        bldgs = list(BuildingTemplate.objects())
+    for bldg in bldgs:
+        bldg.prefetch()
+    document_cache.get_many([bldg.key for bldg in bldgs])
+
+    shared = {}
+
+    def shared_idf():
+        if "idf" not in shared:
+            shared["idf"] = _new_idf()
+        return shared["idf"]
+
+    modes = {
+        "idf_per_template": _new_idf,
+        "shared_idf": shared_idf,
+        "no_idf": lambda: None,
+    }
+    results = {}
+    for mode, idf_factory in modes.items():
+        start = time.perf_counter()
+        try:
+            for _ in range(repeat):
+                for bldg in bldgs:
+                    bldg.to_template(idf=idf_factory())
+        except Exception as e:
+            log.warning(f"benchmark mode '{mode}' failed: {e!r}")
+            results[mode] = {"error": repr(e)}
+            continue
+        total = time.perf_counter() - start
+        results[mode] = {
+            "per_template": total / max(len(bldgs) * repeat, 1),
+            "total": total,
+        }
+    return results
+
+
+def format_report(results):
+    """Format the results of a benchmark as a text table."""
+    lines = [f"{'mode':<20}{'per template (ms)':>20}{'total (s)':>13}"]
+    for mode, result in results.items():
+        if "error" in result:
+            lines.append(f"{mode:<20}  failed: {result['error']}")
+        else:
+            lines.append(
+                f"{mode:<20}{result['per_template'] * 1000:>20.1f}"
+                f"{result['total']:>13.3f}"
+            )
+    return "\n".join(lines)
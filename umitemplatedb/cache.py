@@ -0,0 +1,138 @@
+"""Process-wide read-through cache of raw component documents.
+
+Exporting many templates in one process fetches the same DaySchedule,
+YearSchedule, Material and construction documents again for every template.
+:data:`document_cache` keeps the raw documents keyed on :attr:`UmiBase.key`
+with a size-bounded LRU eviction and an optional time-to-live. It is used by
+:meth:`BuildingTemplate.to_template` and invalidated by :meth:`UmiBase.save` and
+:meth:`UmiBase.delete`.
+
+References are dereferenced through the cache too: the schema declares them
+with :class:`~umitemplatedb.mongodb_schema.CachedReferenceField`, so that
+attribute access such as `bldg.Core.Loads` only queries the database on a
+miss. Walking a whole graph this way still costs one lookup per reference:
+fetch it with :meth:`BuildingTemplate.prefetch` to batch the misses.
+
+When several processes write to the same database, set a `ttl` so that changes
+made by the other processes are eventually picked up:
+
+    >>> from umitemplatedb.cache import document_cache
+    >>> document_cache.ttl = 60  # seconds
+    >>> document_cache.stats()
+    {'hits': 0, 'misses': 0, 'evictions': 0, 'size': 0, 'hit_rate': 0.0}
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from umitemplatedb.graph import mongo_get_many
+
+log = logging.getLogger(__name__)
+
+
+class DocumentCache(object):
+    """A thread-safe LRU cache of raw documents with read-through loading.
+
+    Cached documents are shared: callers must not modify them.
+
+    Args:
+        maxsize (int): Maximum number of cached documents. 0 disables caching.
+        ttl (float): Optional time-to-live of the entries, in seconds.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (timestamp, son)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._get(key) is not None
+
+    def _get(self, key):
+        """Return the cached document or None. Must be called with the lock."""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        timestamp, son = entry
+        if self.ttl is not None and time.monotonic() - timestamp > self.ttl:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return son
+
+    def put_many(self, sons):
+        """Add raw documents to the cache, evicting the least recently used."""
+        if not self.maxsize:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for son in sons:
+                self._data[son["_id"]] = (now, son)
+                self._data.move_to_end(son["_id"])
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_many(self, keys, loader=mongo_get_many):
+        """Return the raw documents of keys, loading the missing ones.
+
+        Args:
+            keys (iterable of str): The keys to get.
+            loader (callable): Called with the list of missing keys. Must return
+                their raw documents. Defaults to a single `$in` query on the
+                UmiBase collection.
+
+        Returns:
+            list of dict: The raw documents found. Missing keys are ignored.
+        """
+        found, missing = [], []
+        with self._lock:
+            for key in keys:
+                son = self._get(key)
+                if son is None:
+                    missing.append(key)
+                else:
+                    found.append(son)
+            self.hits += len(found)
+            self.misses += len(missing)
+        if missing:
+            loaded = loader(missing)
+            self.put_many(loaded)
+            found.extend(loaded)
+        return found
+
+    def invalidate(self, *keys):
+        """Remove keys from the cache."""
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all entries and reset the statistics."""
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return the hit, miss and eviction counts and the hit rate."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._data),
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+#: The cache used by :meth:`BuildingTemplate.to_template`.
+document_cache = DocumentCache()
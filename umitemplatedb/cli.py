@@ -0,0 +1,506 @@
+"""Command-line interface.
+
+Examples:
+    Import libraries, two files at a time::
+
+        umitemplatedb --db templatelibrary import --jobs 2 \\
+            --meta Country=USA --meta Authors=Doe lib1.json lib2.json
+
+    Export the French templates, one UMI file per template::
+
+        umitemplatedb export --filter Country=FRA --per-template -o out/
+
+    Load test a local mongod with 32 clients and 10000 synthetic templates::
+
+        umitemplatedb --host "mongodb://localhost/?maxPoolSize=10" \\
+            loadtest --clients 32 --synthetic 10000 --duration 30
+
+    Keep a local SQLite copy of the French templates up to date::
+
+        umitemplatedb sync --filter Country=FRA templates.db
+
+    Find dangling references and delete the unused components::
+
+        umitemplatedb check --repair --gc
+
+    Time an export::
+
+        umitemplatedb --profile export --jobs 4 -o library.json
+
+    Profile the memory of an import and keep a cProfile dump::
+
+        umitemplatedb --profile-memory --profile-output import.prof import lib.json
+"""
+
+import argparse
+import json
+import logging
+import sys
+
+from mongoengine import ListField
+
+from umitemplatedb.profiling import profiler
+
+log = logging.getLogger(__name__)
+
+
+def _parse_pairs(pairs, list_separator=","):
+    """Parse "Field=value" pairs into BuildingTemplate attributes."""
+    from umitemplatedb.mongodb_schema import BuildingTemplate
+
+    attributes = {}
+    for pair in pairs or []:
+        name, sep, value = pair.partition("=")
+        if not sep:
+            raise argparse.ArgumentTypeError(f"expected Field=value, got '{pair}'")
+        field = BuildingTemplate._fields.get(name)
+        if field is None:
+            raise argparse.ArgumentTypeError(f"unknown field '{name}'")
+        if isinstance(field, ListField):
+            attributes[name] = [
+                field.field.to_python(v) for v in value.split(list_separator)
+            ]
+        else:
+            attributes[name] = field.to_python(value)
+    return attributes
+
+
+def _filters(args):
+    from umitemplatedb.server import parse_filters
+
+    pairs = []
+    for pair in args.filter or []:
+        name, sep, value = pair.partition("=")
+        if not sep:
+            raise argparse.ArgumentTypeError(f"expected Field=value, got '{pair}'")
+        pairs.append((name, value))
+    return parse_filters(pairs)
+
+
+def _parse_metadata(parser, args):
+    """Parse the --filter and --meta values of args, or exit with a usage
+    error."""
+    try:
+        if hasattr(args, "filter"):
+            args.filters = _filters(args)
+        if hasattr(args, "meta"):
+            args.meta = _parse_pairs(args.meta)
+    except (argparse.ArgumentTypeError, ValueError) as e:
+        parser.error(str(e))
+
+
+def cmd_import(args):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from umitemplatedb.core import import_umitemplate
+
+    def run(filename):
+        return import_umitemplate(
+            filename,
+            chunk_size=args.batch_size,
+            resume=not args.no_resume,
+            **args.meta,
+        )
+
+    with ThreadPoolExecutor(max_workers=args.jobs or 1) as pool:
+        for filename, state in zip(args.files, pool.map(run, args.files)):
+            print(f"{filename}: {state}")
+
+
+def cmd_export(args):
+    if (args.per_template or args.format == "parquet") and not args.output:
+        raise SystemExit("--output is required to write a directory")
+    filters = args.filters
+    if args.format == "parquet":
+        from umitemplatedb.columnar import write_parquet
+
+        written = write_parquet(args.output, batch_size=args.batch_size, **filters)
+        print("\n".join(written))
+        return
+
+    from umitemplatedb.core import export_templates
+
+    result = export_templates(
+        jobs=args.jobs,
+        executor=args.executor,
+        connect_kwargs={"db": args.db, "host": args.host},
+        path=args.output if args.per_template else None,
+        **filters,
+    )
+    if args.per_template:
+        print("\n".join(result))
+        return
+    with profiler.phase("export.write"):
+        body = result.to_json()
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(body)
+    else:
+        sys.stdout.write(body)
+
+
+def cmd_query(args):
+    from bson import json_util
+
+    from umitemplatedb.server import catalog
+
+    entries = catalog(**args.filters)
+    if args.json:
+        print(json_util.dumps(entries, indent=2))
+        return
+    for entry in entries:
+        country = ",".join(entry.get("Country", []))
+        years = f"{entry.get('YearFrom', '')}-{entry.get('YearTo', '')}"
+        print(f"{entry['key']:<50} {country:<12} {years}")
+
+
+def cmd_index(args):
+    from umitemplatedb.mongodb_schema import (
+        BuildingTemplate,
+        CountryGeometry,
+        FacetCount,
+        ImportCheckpoint,
+        ReferenceIndex,
+        Tombstone,
+        UmiBase,
+    )
+    from umitemplatedb.facets import rebuild_facets
+    from umitemplatedb.references import rebuild_index
+
+    with profiler.phase("index.ensure_indexes"):
+        for document in (
+            UmiBase,
+            BuildingTemplate,
+            CountryGeometry,
+            ReferenceIndex,
+            FacetCount,
+            Tombstone,
+            ImportCheckpoint,
+        ):
+            document.ensure_indexes()
+    with profiler.phase("index.references"):
+        count = rebuild_index(batch_size=args.batch_size)
+    print(f"reference index rebuilt with {count} entries")
+    with profiler.phase("index.facets"):
+        count = rebuild_facets(batch_size=args.batch_size)
+    print(f"facet counts rebuilt with {count} values")
+
+
+def cmd_facets(args):
+    from umitemplatedb.facets import facets
+
+    counts = facets(*args.facets)
+    if args.json:
+        print(json.dumps(counts, indent=2))
+        return
+    for facet, values in counts.items():
+        print(f"{facet}:")
+        for value, count in values.items():
+            print(f"  {value:<40} {count:>6}")
+
+
+def cmd_sync(args):
+    import os
+
+    from umitemplatedb.storage import SQLiteStore
+    from umitemplatedb.sync import sync
+
+    if args.full and os.path.exists(args.mirror):
+        os.remove(args.mirror)
+    with SQLiteStore(args.mirror) as mirror:
+        changes = sync(mirror, **args.filters)
+    print(
+        f"{len(changes['documents'])} documents updated and "
+        f"{len(changes['deleted'])} deleted in {args.mirror}"
+    )
+
+
+def cmd_loadtest(args):
+    from umitemplatedb.loadtest import format_report, run, synthesize
+
+    if args.synthetic:
+        with profiler.phase("loadtest.synthesize"):
+            synthesize(args.synthetic, seed=args.seed, batch_size=args.batch_size)
+    mix = None
+    if args.mix:
+        mix = {}
+        for pair in args.mix.split(","):
+            name, _, weight = pair.partition("=")
+            mix[name] = float(weight or 1)
+    report = run(
+        mix,
+        clients=args.clients,
+        duration=args.duration,
+        requests=args.requests,
+        seed=args.seed,
+    )
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+
+
+def cmd_migrate(args):
+    from umitemplatedb.geometry import migrate_country_geometries
+
+    with profiler.phase("migrate.geometries"):
+        count = migrate_country_geometries(batch_size=args.batch_size)
+    print(f"moved the country geometries of {count} templates")
+
+
+def cmd_check(args):
+    from umitemplatedb.integrity import check_integrity, repair
+
+    with profiler.phase("check.scan"):
+        report = check_integrity(batch_size=args.batch_size)
+    gc = args.gc
+    if gc and report["misfiled"]:
+        print("misfiled documents found: orphans are not deleted", file=sys.stderr)
+        gc = False
+    if args.repair or args.gc:
+        with profiler.phase("check.repair"):
+            report["repaired"] = repair(report, gc=gc, batch_size=args.batch_size)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(
+            f"checked {report['references']} references of "
+            f"{report['documents']} documents"
+        )
+        for source, path, target in report["dangling"]:
+            print(f"dangling: {source} {path} -> {target}")
+        for source, path, target, expected, actual in report["mismatched"]:
+            print(f"mismatched: {source} {path} -> {target} ({actual}, not {expected})")
+        for key, cls_name, reason in report["misfiled"]:
+            print(f"misfiled: {key} ({cls_name}): {reason}")
+        for key in report["broken_templates"]:
+            print(f"broken template: {key}")
+        print(f"{len(report['orphans'])} orphaned components")
+        if "repaired" in report:
+            repaired = report["repaired"]
+            print(
+                f"re-pointed {len(repaired['repointed'])} references, deleted "
+                f"{len(repaired['deleted'])} orphans"
+            )
+    repointed = report.get("repaired", {}).get("repointed", [])
+    problems = len(report["dangling"]) - len(repointed)
+    return 1 if problems or report["mismatched"] or report["misfiled"] else 0
+
+
+def cmd_bench(args):
+    from umitemplatedb.bench import bench_to_template, format_report
+
+    results = bench_to_template(repeat=args.repeat)
+    print(format_report(results))
+
+
+def build_parser():
+    """Return the argument parser of the command-line interface."""
+    parser = argparse.ArgumentParser(
+        prog="umitemplatedb", description="Manage a database of UMI templates."
+    )
+    parser.add_argument("--db", default="templatelibrary", help="database name")
+    parser.add_argument(
+        "--host",
+        default="mongodb://localhost",
+        help="MongoDB URI, or mongomock://localhost for an in-memory database",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print per-phase timings and database round trips (JSON, on stderr)",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="also measure the memory allocated by each phase (implies --profile)",
+    )
+    parser.add_argument(
+        "--profile-output",
+        metavar="PATH",
+        help="write the profile to PATH instead of stderr: JSON, or a cProfile "
+        "dump if PATH ends with .prof, or a tracemalloc snapshot if it ends "
+        "with .tracemalloc (implies --profile)",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+
+    parallel = argparse.ArgumentParser(add_help=False)
+    parallel.add_argument(
+        "-j", "--jobs", type=int, default=None, help="number of parallel workers"
+    )
+    batching = argparse.ArgumentParser(add_help=False)
+    batching.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="documents per bulk read/write (templates per checkpoint on import)",
+    )
+    filtering = argparse.ArgumentParser(add_help=False)
+    filtering.add_argument(
+        "-f",
+        "--filter",
+        action="append",
+        metavar="FIELD=VALUE",
+        help="filter on template metadata, e.g. Country=FRA or YearFrom__gte=1980",
+    )
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser(
+        "import", parents=[parallel, batching], help="import UMI Template Files"
+    )
+    p.add_argument("files", nargs="+")
+    p.add_argument(
+        "-m",
+        "--meta",
+        action="append",
+        metavar="FIELD=VALUE",
+        help="metadata set on every imported template, e.g. Country=FRA,BEL",
+    )
+    p.add_argument(
+        "--no-resume", action="store_true", help="ignore previous checkpoints"
+    )
+    p.set_defaults(func=cmd_import, batch_size=10)
+
+    p = subparsers.add_parser(
+        "export", parents=[parallel, batching, filtering], help="export templates"
+    )
+    p.add_argument(
+        "--executor",
+        choices=("thread", "process"),
+        help="convert in threads sharing the document cache, or in processes "
+        "scaling with the cores (default: process, thread with mongomock)",
+    )
+    p.add_argument("-o", "--output", help="output file (or directory)")
+    p.add_argument(
+        "--per-template",
+        action="store_true",
+        help="write one UMI file per template in the output directory",
+    )
+    p.add_argument("--format", choices=("umi", "parquet"), default="umi")
+    p.set_defaults(func=cmd_export)
+
+    p = subparsers.add_parser(
+        "query", parents=[filtering], help="list matching templates"
+    )
+    p.add_argument("--json", action="store_true", help="print JSON entries")
+    p.set_defaults(func=cmd_query)
+
+    p = subparsers.add_parser(
+        "index", parents=[batching], help="create indexes and rebuild derived data"
+    )
+    p.set_defaults(func=cmd_index)
+
+    p = subparsers.add_parser("facets", help="print the template counts per facet")
+    p.add_argument(
+        "facets", nargs="*", help="facets to print, e.g. Country (default: all)"
+    )
+    p.add_argument("--json", action="store_true", help="print JSON counts")
+    p.set_defaults(func=cmd_facets)
+
+    p = subparsers.add_parser(
+        "sync",
+        parents=[filtering],
+        help="bring a SQLite mirror up to date with the changes of the database",
+    )
+    p.add_argument("mirror", help="SQLite file of the mirror, created if needed")
+    p.add_argument(
+        "--full",
+        action="store_true",
+        help="rebuild the mirror from scratch instead of copying the changes",
+    )
+    p.set_defaults(func=cmd_sync)
+
+    p = subparsers.add_parser(
+        "loadtest",
+        parents=[batching],
+        help="run concurrent catalog queries, geo lookups and exports",
+    )
+    p.add_argument(
+        "-c", "--clients", type=int, default=8, help="number of concurrent clients"
+    )
+    p.add_argument("--duration", type=float, default=10.0, help="seconds")
+    p.add_argument(
+        "-n", "--requests", type=int, help="operations per client (instead of time)"
+    )
+    p.add_argument(
+        "--mix",
+        metavar="OP=WEIGHT,...",
+        help="weights of the operations among catalog, geo, facets, fetch and "
+        "export, e.g. catalog=5,export=1",
+    )
+    p.add_argument(
+        "--synthetic",
+        type=int,
+        default=0,
+        metavar="N",
+        help="first add N synthetic templates copied from the imported ones",
+    )
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--json", action="store_true", help="print a JSON report")
+    p.set_defaults(func=cmd_loadtest)
+
+    p = subparsers.add_parser(
+        "migrate",
+        parents=[batching],
+        help="move the country geometries embedded in templates to their "
+        "shared collection",
+    )
+    p.set_defaults(func=cmd_migrate)
+
+    p = subparsers.add_parser(
+        "check",
+        parents=[batching],
+        help="check the references between documents; exits with 1 on problems",
+    )
+    p.add_argument(
+        "--repair",
+        action="store_true",
+        help="re-point dangling references to renamed or merged components",
+    )
+    p.add_argument(
+        "--gc",
+        action="store_true",
+        help="delete the components no template uses (implies --repair)",
+    )
+    p.add_argument("--json", action="store_true", help="print a JSON report")
+    p.set_defaults(func=cmd_check)
+
+    p = subparsers.add_parser("bench", help="benchmark template conversion")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=cmd_bench)
+    return parser
+
+
+def main(argv=None):
+    """Entry point of the `umitemplatedb` command."""
+    from mongoengine import connect
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    _parse_metadata(parser, args)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    output = args.profile_output
+    if args.profile or args.profile_memory or output:
+        profiler.reset()
+        profiler.enable(
+            memory=args.profile_memory or str(output).endswith(".tracemalloc"),
+            commands=True,
+            cprofile=str(output).endswith(".prof"),
+        )
+    connect(args.db, host=args.host)
+    try:
+        with profiler.phase(f"cli.{args.command}"):
+            status = args.func(args)
+    finally:
+        if profiler.enabled:
+            if output:
+                profiler.dump(output)
+            else:
+                print(json.dumps(profiler.report(), indent=2), file=sys.stderr)
+            profiler.disable()
+    return status or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""Columnar (Arrow/Parquet) export of the component collections.
+
+Tables are built directly from the raw documents returned by the driver,
+without going through :meth:`BuildingTemplate.to_template`. There is one table
+per document class (e.g. "OpaqueMaterial", "ZoneLoad", "BuildingTemplate")
+with a "key" column holding :attr:`UmiBase.key`. References are stored as the
+key of the referenced document, which makes them usable as foreign keys.
+Embedded lists (`Layers`, `MassRatios`, `Parts`) and lists of references
+(`WeekSchedule.Days`) are flattened into child tables named
+"<Class>.<Field>" with "parent" and "index" columns.
+
+Example:
+    >>> from umitemplatedb.columnar import export_tables
+    >>> tables = export_tables(Country="FRA", YearFrom__gte=1980)
+    >>> tables["OpaqueMaterial"].to_pandas()
+"""
+import logging
+import os
+from collections import defaultdict
+
+from mongoengine import (
+    EmbeddedDocumentListField,
+    FloatField,
+    ListField,
+    MultiPolygonField,
+    PolygonField,
+    ReferenceField,
+)
+from mongoengine.base import get_document
+
+from umitemplatedb.graph import document_class, iter_documents
+
+log = logging.getLogger(__name__)
+
+_GEOMETRY_FIELDS = (PolygonField, MultiPolygonField)
+
+
+def _columns(cls, include_geometry=False):
+    """Return the (db_field, field) pairs making up the table of cls."""
+    columns = []
+    for name, field in cls._fields.items():
+        if name == "_cls" or field.primary_key:
+            continue
+        if isinstance(field, _GEOMETRY_FIELDS) and not include_geometry:
+            continue
+        columns.append((field.db_field, field))
+    return columns
+
+
+def _embedded_columns(document_type):
+    """Return the union of the columns of an embedded class and its subclasses."""
+    columns = {}
+    for cls_name in document_type._subclasses:
+        for db_field, field in _columns(get_document(cls_name)):
+            columns.setdefault(db_field, field)
+    return list(columns.items())
+
+
+def _is_nested(field):
+    """Return True if field is flattened into a child table."""
+    return isinstance(field, EmbeddedDocumentListField) or (
+        isinstance(field, ListField) and isinstance(field.field, ReferenceField)
+    )
+
+
+class _TableBuilder(object):
+    """Accumulate rows of raw documents into per-class columns."""
+
+    def __init__(self, include_geometry=False):
+        self.include_geometry = include_geometry
+        self.columns = {}  # table name -> list of (db_field, field)
+        self.data = defaultdict(lambda: defaultdict(list))
+
+    def _append(self, table, row, columns):
+        if table not in self.columns:
+            self.columns[table] = columns
+        data = self.data[table]
+        for db_field, field in self.columns[table]:
+            data[db_field].append(row.get(db_field))
+
+    def add(self, son):
+        cls = document_class(son)
+        table = cls.__name__
+        key = son["_id"]
+        columns = [("key", None), ("_cls", None)]
+        for db_field, field in _columns(cls, self.include_geometry):
+            if not _is_nested(field):
+                columns.append((db_field, field))
+            elif isinstance(field, EmbeddedDocumentListField):
+                child_columns = [("parent", None), ("index", None), ("_cls", None)]
+                child_columns += _embedded_columns(field.field.document_type)
+                for i, item in enumerate(son.get(db_field) or []):
+                    row = dict(item, parent=key, index=i)
+                    self._append(f"{table}.{db_field}", row, child_columns)
+            else:
+                child_columns = [("parent", None), ("index", None), (db_field, None)]
+                for i, ref in enumerate(son.get(db_field) or []):
+                    row = {"parent": key, "index": i, db_field: ref}
+                    self._append(f"{table}.{db_field}", row, child_columns)
+        self._append(table, dict(son, key=key, _cls=table), columns)
+
+    def to_arrow(self):
+        import pyarrow as pa
+
+        return {
+            table: pa.table(
+                {db_field: self.data[table][db_field] for db_field, _ in columns}
+            )
+            for table, columns in self.columns.items()
+        }
+
+    def to_numpy(self):
+        import numpy as np
+
+        tables = {}
+        for table, columns in self.columns.items():
+            dtype = [
+                (db_field, "f8" if isinstance(field, FloatField) else "O")
+                for db_field, field in columns
+            ]
+            length = len(self.data[table][columns[0][0]])
+            array = np.empty(length, dtype=dtype)
+            for db_field, field in columns:
+                values = self.data[table][db_field]
+                if isinstance(field, FloatField):
+                    values = [float("nan") if v is None else v for v in values]
+                array[db_field] = values
+            tables[table] = array
+        return tables
+
+
+def export_tables(
+    query=None, batch_size=1000, include_geometry=False, backend="arrow", **filters
+):
+    """Export the component collections as columnar tables.
+
+    Args:
+        query (Q): Optional mongoengine query object on BuildingTemplate.
+        batch_size (int): Number of documents fetched per round trip.
+        include_geometry (bool): If True, the Polygon and MultiPolygon columns
+            of BuildingTemplate are included. They are skipped by default since
+            they are by far the largest fields.
+        backend (str): "arrow" to return :class:`pyarrow.Table` objects or
+            "numpy" to return NumPy structured arrays. Float fields are stored
+            as float64 (with NaN for missing values), other fields as objects.
+        **filters: mongoengine keyword filters on BuildingTemplate metadata.
+
+    Returns:
+        dict: Tables keyed by name, e.g. "OpaqueMaterial" or
+            "OpaqueConstruction.Layers".
+    """
+    if backend not in ("arrow", "numpy"):
+        raise ValueError(f"backend must be 'arrow' or 'numpy', not '{backend}'")
+    builder = _TableBuilder(include_geometry=include_geometry)
+    for son in iter_documents(query, batch_size=batch_size, **filters):
+        builder.add(son)
+    if backend == "arrow":
+        return builder.to_arrow()
+    return builder.to_numpy()
+
+
+def write_parquet(path, query=None, batch_size=1000, **filters):
+    """Write the tables of :func:`export_tables` as Parquet files.
+
+    Args:
+        path (str or Path): Output directory. One "<table>.parquet" file is
+            written per table.
+        query (Q): Optional mongoengine query object on BuildingTemplate.
+        batch_size (int): Number of documents fetched per round trip.
+        **filters: mongoengine keyword filters on BuildingTemplate metadata.
+
+    Returns:
+        list of str: The paths of the written files.
+    """
+    import pyarrow.parquet as pq
+
+    os.makedirs(path, exist_ok=True)
+    written = []
+    tables = export_tables(query, batch_size=batch_size, **filters)
+    for name, table in tables.items():
+        filename = os.path.join(path, f"{name}.parquet")
+        pq.write_table(table, filename)
+        written.append(filename)
+        log.info(f"wrote {table.num_rows} rows to {filename}")
+    return written
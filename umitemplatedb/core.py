@@ -1,4 +1,8 @@
+import hashlib
 import logging
+import re
+import time
+from datetime import datetime
 from enum import Enum
 
 from archetypal.umi_template import traverse
@@ -7,74 +11,431 @@ from tqdm import tqdm
 
 import archetypal
 from umitemplatedb import mongodb_schema
-from umitemplatedb.mongodb_schema import BuildingTemplate
+from umitemplatedb.mongodb_schema import BuildingTemplate, ImportCheckpoint
+from umitemplatedb.profiling import profiler
 
 log = logging.getLogger(__name__)
 
 
-def import_umitemplate(filename, **kwargs):
+def import_umitemplate(
+    filename,
+    chunk_size=10,
+    max_cached_components=10000,
+    resume=True,
+    progress=None,
+    **kwargs,
+):
     """Imports an UMI Template File to a mongodb client
 
+    BuildingTemplates are imported in chunks. Components shared by the templates
+    of a chunk (schedules, materials, constructions, etc.) are converted and
+    saved once. After each chunk, the names of the imported templates are
+    recorded in an :class:`~umitemplatedb.mongodb_schema.ImportCheckpoint`, so
+    that running the same import again after a failure resumes after the last
+    completed chunk.
+
+    The whole file is still parsed at once by
+    :meth:`~archetypal.umi_template.UmiTemplateLibrary.open`: the peak memory of
+    an import grows with the size of the library. Chunks only bound the
+    converted Documents kept on top of it.
+
     Args:
         filename (str or Path): PathLike object giving the pathname (absolute
                 or relative to the current working directory) of the UMI
                 Template File.
+        chunk_size (int): Number of BuildingTemplates imported between two
+            checkpoints.
+        max_cached_components (int): Maximum number of converted Documents
+            kept for reuse by the next templates. The chunk is closed early
+            when it is exceeded and the converted Documents are released.
+        resume (bool): If True, templates recorded in the checkpoint of a
+            previous, unfinished, import of the same file (with the same
+            keyword arguments) are skipped, unless they were deleted since. If
+            False, the checkpoint is discarded. Finished imports are never
+            resumed: importing a file again imports all its templates.
+        progress (callable): Called with an :class:`ImportProgress` after each
+            template. Defaults to a tqdm progress bar.
         **kwargs: keyword arguments added to the BuildingTemplate class.
+
+    Returns:
+        ImportProgress: The final state of the import.
     """
     from archetypal import UmiTemplateLibrary
 
+    with profiler.phase("import.checkpoint"):
+        checkpoint = _checkpoint(filename, resume, **kwargs)
+    completed = set(checkpoint.completed)
+
     # first, load the umitemplatelibrary
-    lib = UmiTemplateLibrary.open(filename)
+    with profiler.phase("import.open"):
+        lib = UmiTemplateLibrary.open(filename)
+
+    state = ImportProgress(len(lib.BuildingTemplates))
+    bar = None
+    if progress is None:
+        bar = tqdm(total=state.total, desc="importing templates")
+        progress = state.update_bar(bar)
+
+    memo, chunk = {}, []
+
+    def commit():
+        checkpoint.update(
+            add_to_set__completed=chunk, set__DateModified=datetime.utcnow()
+        )
+        chunk.clear()
+        memo.clear()
+        state.checkpoints += 1
 
     # Loop over building templates
-    for bldgtemplate in tqdm(lib.BuildingTemplates, desc="importing templates"):
-
-        def recursive(umibase, **metaattributes):
-            """recursively create db objects from UmiBase objects. Start with
-            BuildingTemplates."""
-            instance_attr = {}
-            class_ = getattr(mongodb_schema, type(umibase).__name__)
-            for key, value in umibase.mapping().items():
+    for bldgtemplate in lib.BuildingTemplates:
+        state.current = bldgtemplate.Name
+        if bldgtemplate.Name in completed:
+            state.skipped += 1
+        else:
+            before = len(memo)
+            with profiler.phase("import.convert"):
+                to_document(bldgtemplate, memo=memo, **kwargs)
+            state.components += len(memo) - before
+            chunk.append(bldgtemplate.Name)
+            if len(chunk) >= chunk_size or len(memo) > max_cached_components:
+                commit()
+        state.done += 1
+        progress(state)
+    if chunk:
+        commit()
+    checkpoint.update(set__finished=True)
+    if bar is not None:
+        bar.close()
+    return state
+
+
+def _checkpoint(filename, resume=True, **kwargs):
+    """Return the ImportCheckpoint of an import, creating it if needed."""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    digest.update(repr(sorted(kwargs.items())).encode())
+    key = digest.hexdigest()
+    if not resume:
+        ImportCheckpoint.objects(key=key).delete()
+    else:
+        ImportCheckpoint.objects(key=key, finished=True).delete()
+    checkpoint = ImportCheckpoint.objects(key=key).first()
+    if checkpoint is None:
+        return ImportCheckpoint(key=key, filename=str(filename)).save()
+    # Templates deleted since the interruption are imported again
+    keys = [", ".join(["BuildingTemplate", name]) for name in checkpoint.completed]
+    existing = set(BuildingTemplate.objects(key__in=keys).scalar("Name"))
+    missing = [name for name in checkpoint.completed if name not in existing]
+    if missing:
+        checkpoint.update(pull_all__completed=missing)
+        checkpoint.reload()
+    if checkpoint.completed:
+        log.info(
+            f"resuming import of {filename}: "
+            f"{len(checkpoint.completed)} templates already imported"
+        )
+    return checkpoint
+
+
+class ImportProgress(object):
+    """State of an import, passed to the `progress` callback.
+
+    Attributes:
+        total (int): Number of BuildingTemplates in the file.
+        done (int): Number of BuildingTemplates processed, including skipped.
+        skipped (int): Number of BuildingTemplates skipped because they were
+            imported by a previous, interrupted, import.
+        components (int): Number of components converted and saved.
+        checkpoints (int): Number of checkpoints written.
+        current (str): Name of the last processed BuildingTemplate.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.skipped = 0
+        self.components = 0
+        self.checkpoints = 0
+        self.current = None
+        self.start = time.monotonic()
+
+    @property
+    def elapsed(self):
+        """Seconds since the start of the import."""
+        return time.monotonic() - self.start
+
+    @property
+    def rate(self):
+        """Imported templates per second, excluding skipped templates."""
+        imported = self.done - self.skipped
+        return imported / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def eta(self):
+        """Estimated seconds remaining, or None if unknown."""
+        if not self.rate:
+            return None
+        return (self.total - self.done) / self.rate
+
+    def update_bar(self, bar):
+        """Return a progress callback updating a tqdm bar."""
+
+        def callback(state):
+            bar.update(state.done - bar.n)
+            bar.set_postfix(
+                skipped=state.skipped,
+                components=state.components,
+                checkpoints=state.checkpoints,
+                refresh=False,
+            )
+
+        return callback
+
+    def __repr__(self):
+        return (
+            f"ImportProgress(done={self.done}/{self.total}, skipped={self.skipped}, "
+            f"components={self.components}, elapsed={self.elapsed:.1f}s)"
+        )
+
+
+def to_document(umibase, save=None, memo=None, **metaattributes):
+    """Recursively create db objects from UmiBase objects.
+
+    Starts with BuildingTemplates. Documents are created children first so that
+    references can be resolved to their keys when the parent is saved.
+
+    Args:
+        umibase (archetypal.template.umi_base.UmiBase): The archetypal object.
+        save (callable): Function called with each created Document to persist
+            it. Defaults to :meth:`mongoengine.Document.save`.
+        memo (dict): Optional dict of the Documents already created, keyed by
+            the id of the UmiBase objects. Shared components found in memo are
+            not converted and saved again. Updated in place.
+        **metaattributes: keyword arguments added to the BuildingTemplate class.
+
+    Returns:
+        (mongoengine.Document or mongoengine.EmbeddedDocument): The document.
+    """
+    if save is None:
+        save = _save
+    if memo is not None and id(umibase) in memo:
+        return memo[id(umibase)]
+    instance_attr = {}
+    class_ = getattr(mongodb_schema, type(umibase).__name__)
+    for key, value in umibase.mapping().items():
+        if isinstance(
+            value,
+            (
+                archetypal.template.umi_base.UmiBase,
+                archetypal.template.schedule.YearSchedulePart,
+            ),
+        ):
+            instance_attr[key] = to_document(value, save=save, memo=memo)
+        elif isinstance(value, list):
+            instance_attr[key] = []
+            for value in value:
                 if isinstance(
                     value,
                     (
                         archetypal.template.umi_base.UmiBase,
                         archetypal.template.schedule.YearSchedulePart,
+                        archetypal.template.materials.material_layer.MaterialLayer,
+                        archetypal.template.materials.gas_layer.GasLayer,
+                        archetypal.template.structure.MassRatio,
                     ),
                 ):
-                    instance_attr[key] = recursive(value)
-                elif isinstance(value, list):
-                    instance_attr[key] = []
-                    for value in value:
-                        if isinstance(
-                            value,
-                            (
-                                archetypal.template.umi_base.UmiBase,
-                                archetypal.template.schedule.YearSchedulePart,
-                                archetypal.template.materials.material_layer.MaterialLayer,
-                                archetypal.template.materials.gas_layer.GasLayer,
-                                archetypal.template.structure.MassRatio,
-                            ),
-                        ):
-                            instance_attr[key].append(recursive(value))
-                        else:
-                            instance_attr[key].append(value)
-                elif isinstance(value, (str, int, float)):
-                    instance_attr[key] = value
-                elif isinstance(value, Enum):
-                    instance_attr[key] = value.value
-            class_instance = class_(**instance_attr)
-            if isinstance(class_instance, EmbeddedDocument):
-                return class_instance
-            else:
-                class_instance = class_(
-                    **instance_attr,
-                )
-                if isinstance(class_instance, BuildingTemplate):
-                    for key, value in metaattributes.items():
-                        class_instance[key] = value
-                class_instance.save()
-                return class_instance
-
-        # loop starts here
-        recursive(bldgtemplate, **kwargs)
+                    instance_attr[key].append(to_document(value, save=save, memo=memo))
+                else:
+                    instance_attr[key].append(value)
+        elif isinstance(value, (str, int, float)):
+            instance_attr[key] = value
+        elif isinstance(value, Enum):
+            instance_attr[key] = value.value
+    class_instance = class_(**instance_attr)
+    if isinstance(class_instance, EmbeddedDocument):
+        return class_instance
+    else:
+        if isinstance(class_instance, BuildingTemplate):
+            for key, value in metaattributes.items():
+                class_instance[key] = value
+        save(class_instance)
+        if memo is not None:
+            memo[id(umibase)] = class_instance
+        return class_instance
+
+
+def _save(document):
+    return document.save()
+
+
+def export_templates(
+    query=None,
+    jobs=None,
+    executor=None,
+    path=None,
+    connect_kwargs=None,
+    name="unnamed",
+    **filters,
+):
+    """Exports BuildingTemplates to UMI Template Library objects, in parallel.
+
+    The selected templates are split across a pool of workers. Each worker
+    prefetches the reference graph of its share in batch and converts it with
+    :meth:`BuildingTemplate.to_template`, converting the components shared by
+    its templates once. The results are then merged: components converted by
+    several workers are deduplicated on their key, so that each component
+    appears once in the library.
+
+    The conversion is CPU-bound Python. Threads share the mongoengine
+    connection and the :data:`~umitemplatedb.cache.document_cache`, but only
+    overlap their database round trips: the GIL serializes the conversion.
+    Processes scale the conversion with the number of cores, at the cost of
+    opening a connection each (with `connect_kwargs`), fetching the shared
+    components once per process and pickling the results back; they cannot
+    be used with mongomock. Processes are therefore the default when
+    `connect_kwargs` points to a MongoDB server.
+
+    Args:
+        query (Q): Optional mongoengine query object on BuildingTemplate.
+        jobs (int): Number of workers. Defaults to the number of CPUs.
+        executor (str): "thread" or "process". Defaults to "process" if
+            `connect_kwargs` is given and does not point to mongomock,
+            otherwise to "thread".
+        path (str or Path): If given, one UMI Template File per template is
+            written in this directory, named after the template (see
+            :func:`template_filename`), instead of returning a merged library.
+        connect_kwargs (dict): Keyword arguments of :func:`mongoengine.connect`,
+            required with the "process" executor.
+        name (str): The name of the merged UmiTemplateLibrary.
+        **filters: mongoengine keyword filters on BuildingTemplate.
+
+    Returns:
+        UmiTemplateLibrary or list of str: The merged library, or the paths of
+            the written files if `path` is given.
+    """
+    import os
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    args = (query,) if query is not None else ()
+    with profiler.phase("export.query"):
+        keys = list(BuildingTemplate.objects(*args, **filters).scalar("key"))
+    jobs = min(jobs or os.cpu_count() or 1, max(len(keys), 1))
+    shares = [keys[i::jobs] for i in range(jobs)]
+    if path is not None:
+        os.makedirs(path, exist_ok=True)
+
+    if executor is None:
+        host = str((connect_kwargs or {}).get("host") or "")
+        mongomock = host.startswith("mongomock://")
+        executor = "process" if connect_kwargs and not mongomock else "thread"
+    if executor == "thread":
+        pool = ThreadPoolExecutor(max_workers=jobs)
+    elif executor == "process":
+        if connect_kwargs is None:
+            raise ValueError("connect_kwargs is required with executor='process'")
+        pool = ProcessPoolExecutor(
+            max_workers=jobs, initializer=_connect, initargs=(connect_kwargs,)
+        )
+    else:
+        raise ValueError(f"executor must be 'thread' or 'process', not '{executor}'")
+    with pool:
+        results = list(pool.map(_export_share, shares, [path] * len(shares)))
+
+    if path is not None:
+        return [filename for filenames in results for filename in filenames]
+    with profiler.phase("export.merge"):
+        templates = _merge([(t, memo) for t, memo in results])
+    with profiler.phase("export.library"):
+        return _library(templates, name=name)
+
+
+def template_filename(name):
+    """Return a file name for the template named name.
+
+    Characters other than letters, digits, spaces, dots, dashes and
+    underscores (e.g. path separators) are replaced by underscores. A name
+    changed this way is suffixed with a hash of the original, so that "a/b"
+    and "a_b" are not written to the same file.
+    """
+    safe = re.sub(r"[^\w .-]", "_", name).strip(" .") or "_"
+    if safe != name:
+        safe += "-" + hashlib.sha1(name.encode("utf-8")).hexdigest()[:8]
+    return f"{safe}.json"
+
+
+def _connect(connect_kwargs):
+    from mongoengine import connect
+
+    connect(**connect_kwargs)
+
+
+def _export_share(keys, path=None):
+    """Convert the templates of keys. Runs in a worker."""
+    import os
+
+    from umitemplatedb.cache import document_cache
+    from umitemplatedb.graph import fetch_graph
+
+    # Warm the cache with the graph of the whole share, one query per level.
+    with profiler.phase("export.fetch"):
+        fetch_graph(keys, get_many=document_cache.get_many)
+    memo = {}
+    with profiler.phase("export.convert"):
+        templates = [
+            bldg.to_template(memo=memo)
+            for bldg in BuildingTemplate.objects(key__in=keys)
+        ]
+    if path is None:
+        return templates, memo
+    filenames = []
+    for template in templates:
+        filename = os.path.join(path, template_filename(template.Name))
+        with profiler.phase("export.write"):
+            _library([template], name=template.Name).to_json(filename)
+        filenames.append(filename)
+    return filenames
+
+
+def _merge(results):
+    """Merge the templates converted by several workers.
+
+    Args:
+        results (list of tuple): (templates, memo) of each worker, where memo
+            maps database keys to converted objects.
+
+    Returns:
+        list: The templates, sharing one object per database key.
+    """
+    canonical, replace = {}, {}
+    for _, memo in results:
+        for key, obj in memo.items():
+            first = canonical.setdefault(key, obj)
+            if first is not obj:
+                replace[id(obj)] = first
+    templates = [t for templates, _ in results for t in templates]
+    if not replace:
+        return templates
+    for template in templates:
+        for parent, key, child in traverse(template):
+            if key and id(child) in replace:
+                setattr(parent, key, replace[id(child)])
+            if isinstance(child, archetypal.template.WeekSchedule):
+                child.Days = [replace.get(id(day), day) for day in child.Days]
+    return templates
+
+
+def _library(templates, name="unnamed"):
+    """Create an UmiTemplateLibrary with the templates and their components."""
+    from archetypal import UmiTemplateLibrary
+
+    lib = UmiTemplateLibrary(name=name, BuildingTemplates=templates)
+    seen = set()
+    for template in templates:
+        for _, _, child in traverse(template):
+            if isinstance(child, archetypal.template.umi_base.UmiBase):
+                if id(child) not in seen:
+                    seen.add(id(child))
+                    getattr(lib, type(child).__name__ + "s").append(child)
+    return lib
@@ -0,0 +1,148 @@
+"""Materialized facet counts of the BuildingTemplate catalog.
+
+For each facet of :data:`FACETS` and each of its values,
+:class:`~umitemplatedb.mongodb_schema.FacetCount` stores the number of
+BuildingTemplates having this value. Browsing UIs read all the counts with a
+single query, whatever the size of the catalog, instead of aggregating the
+whole collection on every page load.
+
+The counts are updated incrementally by :meth:`BuildingTemplate.save` (and
+thus by imports) and :meth:`BuildingTemplate.delete`. Templates written
+without going through mongoengine (e.g. with
+:meth:`~umitemplatedb.storage.MongoStore.put_many`) require a
+:func:`rebuild_facets`, as do counts drifted by concurrent writes of the same
+template.
+
+Example:
+    >>> from umitemplatedb.facets import facets
+    >>> facets("Country", "YearFrom")
+    {'Country': {'FRA': 12, 'USA': 4}, 'YearFrom': {'1980-1989': 9, ...}}
+"""
+import logging
+from collections import Counter
+
+from pymongo import UpdateOne
+
+from umitemplatedb import mongodb_schema
+
+log = logging.getLogger(__name__)
+
+#: The BuildingTemplate fields counted.
+FACETS = ("Country", "ClimateZone", "Category", "YearFrom", "YearTo", "Authors")
+
+#: Width of the YearFrom and YearTo buckets, in years.
+YEAR_BUCKET = 10
+
+
+def year_bucket(year):
+    """Return the label of the bucket of year, e.g. "1980-1989"."""
+    start = year - year % YEAR_BUCKET
+    return f"{start}-{start + YEAR_BUCKET - 1}"
+
+
+def facet_values(son):
+    """Return the set of (facet, value) pairs of a raw BuildingTemplate."""
+    if son is None:
+        return set()
+    pairs = set()
+    for facet in FACETS:
+        value = son.get(facet)
+        if value is None or value == []:
+            continue
+        if facet in ("YearFrom", "YearTo"):
+            pairs.add((facet, year_bucket(value)))
+        elif isinstance(value, list):
+            pairs.update((facet, str(v)) for v in value)
+        else:
+            pairs.add((facet, str(value)))
+    return pairs
+
+
+def stored_values(key):
+    """Return the (facet, value) pairs of the template key as stored."""
+    collection = mongodb_schema.BuildingTemplate._get_collection()
+    return facet_values(collection.find_one({"_id": key}, dict.fromkeys(FACETS, 1)))
+
+
+def _increment(increments):
+    """Apply a Counter of (facet, value) increments in one round trip."""
+    FacetCount = mongodb_schema.FacetCount
+
+    requests = [
+        UpdateOne(
+            {"_id": f"{facet}={value}"},
+            {"$inc": {"count": n}, "$set": {"facet": facet, "value": value}},
+            upsert=True,
+        )
+        for (facet, value), n in increments.items()
+        if n
+    ]
+    if requests:
+        FacetCount._get_collection().bulk_write(requests, ordered=False)
+    if any(n < 0 for n in increments.values()):
+        FacetCount.objects(count__lte=0).delete()
+
+
+def on_save(document, previous):
+    """Update the counts after a BuildingTemplate was saved.
+
+    Args:
+        document (BuildingTemplate): The saved template.
+        previous (set): Its :func:`stored_values` before the save.
+    """
+    current = facet_values(document.to_mongo())
+    increments = Counter(dict.fromkeys(current - previous, 1))
+    increments.update(dict.fromkeys(previous - current, -1))
+    _increment(increments)
+
+
+def on_delete(previous):
+    """Update the counts after a BuildingTemplate was deleted.
+
+    Args:
+        previous (set): Its :func:`stored_values` before the deletion.
+    """
+    _increment(Counter(dict.fromkeys(previous, -1)))
+
+
+def facets(*names):
+    """Return the template counts per value of the facets.
+
+    Args:
+        *names (str): The facets to return. Defaults to all of :data:`FACETS`.
+
+    Returns:
+        dict: For each facet, a dict of the counts per value, largest first.
+    """
+    names = names or FACETS
+    unknown = set(names) - set(FACETS)
+    if unknown:
+        raise ValueError(f"unknown facets {sorted(unknown)}")
+    result = {name: {} for name in names}
+    entries = mongodb_schema.FacetCount.objects(facet__in=list(names), count__gt=0)
+    for entry in entries.order_by("-count", "value"):
+        result[entry.facet][entry.value] = entry.count
+    return result
+
+
+def rebuild_facets(batch_size=1000):
+    """Recount the facets of all the BuildingTemplates.
+
+    Args:
+        batch_size (int): Number of templates read per round trip.
+
+    Returns:
+        int: The number of facet values.
+    """
+    FacetCount = mongodb_schema.FacetCount
+
+    counts = Counter()
+    collection = mongodb_schema.BuildingTemplate._get_collection()
+    query = mongodb_schema.BuildingTemplate.objects()._query
+    for son in collection.find(query, dict.fromkeys(FACETS, 1), batch_size=batch_size):
+        counts.update(facet_values(son))
+    FacetCount.drop_collection()
+    FacetCount.ensure_indexes()
+    _increment(counts)
+    log.info(f"rebuilt {len(counts)} facet counts")
+    return len(counts)
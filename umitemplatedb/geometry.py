@@ -0,0 +1,193 @@
+"""Helpers for the geometries of the templates.
+
+Country geometries are stored once, in the
+:class:`~umitemplatedb.mongodb_schema.CountryGeometry` collection, and
+referenced by the BuildingTemplates of these countries. Templates keep a
+bounding box and a simplified footprint, enough to list and draw them without
+fetching the full geometries.
+
+Geometries are handled as GeoJSON-like dicts. Coordinates are longitudes and
+latitudes, in degrees.
+"""
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+#: Tolerance of the simplified footprints, in degrees (~10 km at the equator).
+FOOTPRINT_TOLERANCE = 0.1
+
+
+def multipolygon_coordinates(geometry):
+    """Return the coordinates of a Polygon or MultiPolygon as a MultiPolygon.
+
+    Args:
+        geometry (dict): A GeoJSON-like Polygon or MultiPolygon.
+
+    Returns:
+        list: MultiPolygon coordinates.
+    """
+    if not geometry:
+        return []
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiPolygon":
+        return list(geometry["coordinates"])
+    raise TypeError(
+        f"cannot import geometry of type '{geometry['type']}'. "
+        f"Only 'Polygon' and 'MultiPolygon' are supported"
+    )
+
+
+def bounding_box(coordinates):
+    """Return [min lon, min lat, max lon, max lat] of MultiPolygon coordinates.
+
+    Returns None for an empty geometry.
+    """
+    points = [point for polygon in coordinates for ring in polygon for point in ring]
+    if not points:
+        return None
+    lons = [point[0] for point in points]
+    lats = [point[1] for point in points]
+    return [min(lons), min(lats), max(lons), max(lats)]
+
+
+def union_bounding_box(boxes):
+    """Return the bounding box of several bounding boxes, ignoring None."""
+    boxes = [box for box in boxes if box]
+    if not boxes:
+        return None
+    return [
+        min(box[0] for box in boxes),
+        min(box[1] for box in boxes),
+        max(box[2] for box in boxes),
+        max(box[3] for box in boxes),
+    ]
+
+
+def simplify(coordinates, tolerance=FOOTPRINT_TOLERANCE):
+    """Return simplified MultiPolygon coordinates.
+
+    Polygons smaller than the tolerance are dropped. Requires shapely; returns
+    None if it is not installed.
+
+    Args:
+        coordinates (list): MultiPolygon coordinates.
+        tolerance (float): Maximum distance between the original and the
+            simplified outlines, in degrees.
+    """
+    try:
+        from shapely.geometry import Polygon, shape
+    except ImportError:
+        log.warning("shapely is not installed: footprints are not computed")
+        return None
+
+    simplified = shape({"type": "MultiPolygon", "coordinates": coordinates}).simplify(
+        tolerance, preserve_topology=True
+    )
+    polygons = []
+    for polygon in getattr(simplified, "geoms", [simplified]):
+        if not isinstance(polygon, Polygon) or polygon.is_empty:
+            continue
+        min_x, min_y, max_x, max_y = polygon.bounds
+        if max(max_x - min_x, max_y - min_y) < tolerance:
+            continue
+        rings = (polygon.exterior, *polygon.interiors)
+        polygons.append([[list(point) for point in ring.coords] for ring in rings])
+    return polygons
+
+
+def migrate_country_geometries(batch_size=1000):
+    """Move the country geometries embedded in BuildingTemplates to
+    :class:`~umitemplatedb.mongodb_schema.CountryGeometry`.
+
+    Before this migration, :meth:`BuildingTemplate.save` copied the geometry of
+    the first of its countries found into the `Polygon` or `MultiPolygon` of
+    each template. For each template with a Country, the embedded geometry is
+    considered a copy if it is equal to the geometry of one of its Countries:
+    the stored CountryGeometry or, if none is stored yet, the geometry of the
+    geo-countries dataset (which is then stored). For a template with a single
+    Country, a missing CountryGeometry is created from the embedded geometry
+    instead. Copies are
+    removed from the template, which references the CountryGeometry instead.
+    Other embedded geometries are kept as explicit template geometries.
+
+    The DateModified of the migrated templates is updated, so that mirrors
+    pick up the change (see :mod:`umitemplatedb.sync`). Templates already
+    migrated are left untouched: running the migration again is harmless.
+
+    Args:
+        batch_size (int): Number of templates read and written per round trip.
+
+    Returns:
+        int: The number of templates migrated.
+    """
+    from datetime import datetime
+
+    from pymongo import UpdateOne
+
+    from umitemplatedb.cache import document_cache
+    from umitemplatedb.mongodb_schema import BuildingTemplate, CountryGeometry
+
+    countries = {}
+
+    def country_coordinates(code, embedded=None):
+        """Return the coordinates of the CountryGeometry of code, storing it
+        from embedded or from the dataset if needed."""
+        if countries.get(code) is None and (code not in countries or embedded):
+            country = CountryGeometry.objects(ISO3_CODE=code).first()
+            if country is None:
+                if embedded:
+                    country = CountryGeometry.from_geometry(code, embedded)
+                else:
+                    country = CountryGeometry.from_country(code)
+                if country is not None:
+                    country.save()
+            countries[code] = country and _lists(country.geometry["coordinates"])
+        return countries[code]
+
+    collection = BuildingTemplate._get_collection()
+    query = BuildingTemplate.objects(Country__exists=True, Country__ne=[])._query
+    requests, migrated = [], 0
+    for son in collection.find(query, batch_size=batch_size):
+        embedded = son.get("Polygon") or son.get("MultiPolygon")
+        codes = son["Country"]
+        if not embedded and son.get("CountryGeometries") == codes:
+            continue  # already migrated
+        if embedded:
+            coordinates = _lists(multipolygon_coordinates(embedded))
+            single = embedded if len(codes) == 1 else None
+            if any(country_coordinates(c, single) == coordinates for c in codes):
+                embedded = None
+        template = BuildingTemplate._from_son(son)
+        if embedded:
+            update = {"$set": {}}
+        else:
+            template.Polygon = template.MultiPolygon = None
+            update = {"$set": {}, "$unset": {"Polygon": "", "MultiPolygon": ""}}
+        template.set_geometry()
+        migrated_son = template.to_mongo()
+        for name in ("CountryGeometries", "BoundingBox", "Footprint"):
+            if name in migrated_son:
+                update["$set"][name] = migrated_son[name]
+            else:
+                update.setdefault("$unset", {})[name] = ""
+        if all(son.get(k) == v for k, v in update["$set"].items()) and not any(
+            k in son for k in update.get("$unset", {})
+        ):
+            continue  # an explicit geometry already migrated
+        update["$set"]["DateModified"] = datetime.utcnow()
+        requests.append(UpdateOne({"_id": son["_id"]}, update))
+        document_cache.invalidate(son["_id"])
+        if len(requests) >= batch_size:
+            migrated += collection.bulk_write(requests).modified_count
+            requests = []
+    if requests:
+        migrated += collection.bulk_write(requests).modified_count
+    log.info(f"migrated the geometry of {migrated} templates")
+    return migrated
+
+
+def _lists(coordinates):
+    """Return coordinates with lists only, to compare them with ==."""
+    return json.loads(json.dumps(coordinates))
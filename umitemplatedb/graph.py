@@ -0,0 +1,289 @@
+"""Helpers to walk the reference graph of raw (son) documents.
+
+The documents of :mod:`umitemplatedb.mongodb_schema` are stored in a single
+collection and reference each other by their primary key (see
+:attr:`UmiBase.key`). The functions of this module work directly on the raw
+documents returned by the driver so that whole template graphs can be fetched
+with a handful of batched queries instead of one query per dereferenced field.
+"""
+import logging
+from functools import lru_cache
+
+from mongoengine import (
+    Document,
+    EmbeddedDocumentField,
+    EmbeddedDocumentListField,
+    ListField,
+    ReferenceField,
+)
+from mongoengine.base import get_document
+
+log = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def reference_fields(cls):
+    """Describe the fields of a document class that hold references.
+
+    Args:
+        cls (type): A Document or EmbeddedDocument class.
+
+    Returns:
+        tuple: Tuples of (field name, kind, document_type) where kind is one of
+            "ref" (a ReferenceField), "reflist" (a ListField of ReferenceField)
+            or "embedded" (a list of EmbeddedDocuments). For embedded fields,
+            document_type is the declared embedded class.
+    """
+    fields = []
+    for name, field in cls._fields.items():
+        if isinstance(field, ReferenceField):
+            fields.append((field.db_field, "ref", field.document_type))
+        elif isinstance(field, EmbeddedDocumentListField):
+            fields.append((field.db_field, "embedded", field.field.document_type))
+        elif isinstance(field, ListField) and isinstance(field.field, ReferenceField):
+            fields.append((field.db_field, "reflist", field.field.document_type))
+        elif isinstance(field, EmbeddedDocumentField):
+            fields.append((field.db_field, "embedded", field.document_type))
+    return tuple(fields)
+
+
+def document_class(son, default=None):
+    """Return the mongoengine class of a raw document from its `_cls`."""
+    cls_name = son.get("_cls")
+    if cls_name is None:
+        return default
+    return get_document(cls_name)
+
+
+def iter_references(son, cls=None, path=""):
+    """Yield the references held by a raw document.
+
+    Args:
+        son (dict): A raw document, as returned by the driver.
+        cls (type): The document class. Inferred from `_cls` if None.
+        path (str): Prefix used for the returned field paths.
+
+    Yields:
+        tuple: (field path, referenced key, expected document_type). For
+            references held in embedded lists, the field path is
+            "<Field>.<index>.<SubField>", e.g. "Layers.0.Material".
+    """
+    cls = document_class(son, default=cls)
+    for name, kind, document_type in reference_fields(cls):
+        value = son.get(name)
+        if value is None:
+            continue
+        if kind == "ref":
+            yield path + name, value, document_type
+        elif kind == "reflist":
+            for i, key in enumerate(value):
+                yield f"{path}{name}.{i}", key, document_type
+        elif kind == "embedded":
+            items = value if isinstance(value, list) else [value]
+            for i, item in enumerate(items):
+                yield from iter_references(
+                    item, cls=document_type, path=f"{path}{name}.{i}."
+                )
+
+
+def mongo_get_many(keys, projection=None):
+    """Fetch raw UmiBase documents by primary key in a single query.
+
+    Args:
+        keys (iterable of str): The keys to fetch.
+        projection (dict): Optional projection passed to the driver.
+
+    Returns:
+        list of dict: The raw documents found. Missing keys are ignored.
+    """
+    from umitemplatedb.mongodb_schema import UmiBase
+
+    keys = list(keys)
+    if not keys:
+        return []
+    collection = UmiBase._get_collection()
+    return list(collection.find({"_id": {"$in": keys}}, projection))
+
+
+def fetch_graph(root_keys, get_many=None, batch_size=1000):
+    """Fetch every raw document reachable from root_keys.
+
+    The graph is walked breadth-first: each level is fetched with batched
+    `$in` queries, so the number of round trips depends on the depth of the
+    graph (about 7 levels for a BuildingTemplate) and not on its size.
+
+    Args:
+        root_keys (iterable of str): Keys to start from, e.g. BuildingTemplate
+            keys.
+        get_many (callable): A function receiving a list of keys and returning
+            raw documents. Defaults to :func:`mongo_get_many`.
+        batch_size (int): Maximum number of keys per query.
+
+    Returns:
+        dict: Raw documents keyed by their primary key.
+    """
+    if get_many is None:
+        get_many = mongo_get_many
+    docs = {}
+    frontier = set(root_keys)
+    seen = set(frontier)
+    while frontier:
+        frontier = sorted(frontier)
+        for i in range(0, len(frontier), batch_size):
+            for son in get_many(frontier[i : i + batch_size]):
+                docs[son["_id"]] = son
+        frontier = {
+            key
+            for k in frontier
+            if k in docs
+            for _, key, _ in iter_references(docs[k])
+            if key not in seen
+        }
+        seen |= frontier
+    return docs
+
+
+def iter_documents(query=None, batch_size=1000, **filters):
+    """Iterate over the raw documents selected by a template query.
+
+    Filtering on BuildingTemplate metadata is pushed down to the database: only
+    the matching templates are read and only the components reachable from them
+    are fetched, level by level with batched `$in` queries. Without any filter,
+    the whole collection is scanned in batches.
+
+    Args:
+        query (Q): Optional mongoengine query object on BuildingTemplate.
+        batch_size (int): Cursor batch size and maximum number of keys per
+            `$in` query.
+        **filters: mongoengine keyword filters on BuildingTemplate, e.g.
+            `Country="FRA"` or `YearFrom__gte=1980`.
+
+    Yields:
+        dict: Raw documents.
+    """
+    from umitemplatedb.mongodb_schema import BuildingTemplate, UmiBase
+
+    collection = UmiBase._get_collection()
+    if query is None and not filters:
+        yield from collection.find({}, batch_size=batch_size)
+        return
+    args = (query,) if query is not None else ()
+    raw_query = BuildingTemplate.objects(*args, **filters)._query
+    keys = [
+        son["_id"]
+        for son in collection.find(raw_query, {"_id": 1}, batch_size=batch_size)
+    ]
+    yield from fetch_graph(keys, batch_size=batch_size).values()
+
+
+def materialize(key, docs, memo=None):
+    """Create a Document from raw documents, with its references resolved.
+
+    The references of the returned Document (and of its embedded documents) are
+    replaced by Documents built from `docs`, so that accessing them never
+    triggers a database query. Documents shared by several parents are only
+    created once.
+
+    Args:
+        key (str): The key of the document to create.
+        docs (dict): Raw documents keyed by primary key, e.g. the result of
+            :func:`fetch_graph`.
+        memo (dict): Optional dict of already materialized Documents, keyed by
+            primary key. Updated in place.
+
+    Returns:
+        (mongoengine.Document): The Document.
+    """
+    if memo is None:
+        memo = {}
+    return _materialize(key, docs, memo, set())
+
+
+def resolve(document, docs, memo=None):
+    """Resolve the references of an existing Document from raw documents.
+
+    Unlike :func:`materialize`, references that are already Documents are kept
+    (so unsaved changes are not lost) and only their own references are
+    resolved. References missing from `docs` are left untouched and will be
+    dereferenced lazily by mongoengine.
+
+    Args:
+        document (mongoengine.Document): The document, modified in place.
+        docs (dict): Raw documents keyed by primary key.
+        memo (dict): Optional dict of already materialized Documents.
+    """
+    if memo is None:
+        memo = {}
+    _resolve(document, docs, memo, set())
+    return document
+
+
+def unresolved_keys(document):
+    """Return the keys of the references not loaded yet in a Document graph.
+
+    The references of `document`, of its embedded documents and of the
+    Documents it references are walked. References that are still keys (or
+    DBRefs) would each be dereferenced with a query on access.
+
+    Args:
+        document (mongoengine.Document): The document.
+
+    Returns:
+        list: The sorted keys.
+    """
+    keys, seen, stack = set(), set(), [document]
+    while stack:
+        document = stack.pop()
+        if id(document) in seen:
+            continue
+        seen.add(id(document))
+        for name, kind, _ in reference_fields(type(document)):
+            value = document._data.get(name)
+            if value is None:
+                continue
+            for item in value if isinstance(value, list) else [value]:
+                if kind == "embedded" or isinstance(item, Document):
+                    stack.append(item)
+                else:
+                    keys.add(getattr(item, "id", item))  # DBRef or raw key
+    return sorted(keys)
+
+
+def _materialize(key, docs, memo, seen):
+    if key in memo:
+        return memo[key]
+    son = docs[key]
+    document = document_class(son)._from_son(son)
+    memo[key] = document
+    _resolve(document, docs, memo, seen)
+    return document
+
+
+def _resolve(document, docs, memo, seen):
+    """Replace the references of document by materialized Documents, in place."""
+    if id(document) in seen:
+        return
+    seen.add(id(document))
+
+    def lookup(ref):
+        if isinstance(ref, Document):
+            _resolve(ref, docs, memo, seen)
+            return ref
+        key = getattr(ref, "id", ref)  # DBRef or raw key
+        if key in docs:
+            return _materialize(key, docs, memo, seen)
+        log.debug(f"reference to '{key}' not found in '{document}'")
+        return ref
+
+    for name, kind, _ in reference_fields(type(document)):
+        value = document._data.get(name)
+        if value is None:
+            continue
+        if kind == "ref":
+            document._data[name] = lookup(value)
+        elif kind == "reflist":
+            document._data[name] = [lookup(ref) for ref in value]
+        elif kind == "embedded":
+            items = value if isinstance(value, list) else [value]
+            for item in items:
+                _resolve(item, docs, memo, seen)
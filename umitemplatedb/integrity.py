@@ -0,0 +1,238 @@
+"""Bulk referential-integrity checks of the template graph.
+
+References between documents (e.g. `ZoneDefinition.Loads`,
+`WeekSchedule.Days` or `MaterialLayer.Material`) are stored as the keys of
+the referenced documents, which nothing prevents from being deleted. A
+dangling reference is otherwise only found when :meth:`to_template` fails
+partway through an export.
+
+:func:`check_integrity` reads the UmiBase collection once, keeps the keys,
+classes and references of the documents in memory and resolves all the
+references with set operations. It reports:
+
+- dangling references, to keys that do not exist, and the templates they
+  break;
+- mismatched references, to documents of a class not accepted by the field
+  (e.g. a WeekSchedule referencing a YearSchedule in `Days`);
+- misfiled documents, whose `_cls` is unknown or does not match the class in
+  their key;
+- orphans, components that no BuildingTemplate reaches.
+
+The references of misfiled documents are read with the class of their key, so
+that the components they use are not reported as orphans.
+
+:func:`repair` re-points dangling references to the document now holding the
+missing name (e.g. a component re-imported with
+:attr:`UmiBase.content_addressed`, or merged as an alias of an identical one)
+and can delete the orphans.
+
+Example:
+    >>> from umitemplatedb.integrity import check_integrity, repair
+    >>> report = check_integrity()
+    >>> report["dangling"]
+    [('WeekSchedule, B_Off_W_Occ', 'Days.3', 'DaySchedule, B_Off_D_Occ_WD')]
+    >>> repair(report, gc=True)
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+from mongoengine.base import get_document
+from mongoengine.errors import NotRegistered
+from pymongo import UpdateOne
+
+from umitemplatedb import mongodb_schema
+from umitemplatedb.cache import document_cache
+from umitemplatedb.graph import iter_references
+
+log = logging.getLogger(__name__)
+
+#: Fields not read by the checks, to keep the scan light.
+_IGNORED_FIELDS = ("Polygon", "MultiPolygon", "Footprint")
+
+
+def check_integrity(batch_size=1000):
+    """Check the references of all the documents of the UmiBase collection.
+
+    Args:
+        batch_size (int): Number of documents read per round trip.
+
+    Returns:
+        dict: "documents" and "references", the numbers of documents and
+            references checked; "dangling", (source key, field path, target
+            key) tuples; "broken_templates", the keys of the BuildingTemplates
+            reaching a dangling reference; "mismatched", (source key, field
+            path, target key, expected class, actual class) tuples;
+            "misfiled", (key, _cls, reason) tuples; "orphans", the keys of the
+            components no BuildingTemplate reaches; "scanned", the time of the
+            scan (ISO 8601, UTC).
+    """
+    # Truncated like the dates stored by MongoDB
+    now = datetime.utcnow()
+    scanned = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    collection = mongodb_schema.UmiBase._get_collection()
+    projection = dict.fromkeys(_IGNORED_FIELDS, 0)
+    classes, edges, misfiled, templates = {}, [], [], []
+    for son in collection.find({}, projection, batch_size=batch_size):
+        key, cls_name = son["_id"], son.get("_cls", "")
+        prefix = key.split(", ", 1)[0]
+        try:
+            cls = get_document(cls_name)
+        except NotRegistered as e:
+            misfiled.append((key, cls_name, str(e)))
+            classes[key] = None
+            cls = _key_class(prefix)
+            if cls is None:
+                continue
+            son = dict(son, _cls=cls._class_name)
+        else:
+            classes[key] = cls
+            if prefix != cls.__name__:
+                misfiled.append((key, cls_name, f"key of a {prefix}"))
+        references = list(iter_references(son, cls=cls))
+        if issubclass(cls, mongodb_schema.BuildingTemplate):
+            templates.append(key)
+        edges.extend(
+            (key, path, target, expected) for path, target, expected in references
+        )
+
+    dangling, mismatched = [], []
+    adjacency = defaultdict(set)
+    for source, path, target, expected in sorted(edges, key=lambda e: e[:2]):
+        adjacency[source].add(target)
+        if target not in classes:
+            dangling.append((source, path, target))
+            continue
+        actual = classes[target]
+        if actual is not None and not issubclass(actual, expected):
+            mismatched.append(
+                (source, path, target, expected.__name__, actual.__name__)
+            )
+
+    # Reachability from the templates
+    reachers = defaultdict(set)  # key -> templates reaching it
+    for template in templates:
+        frontier, reached = {template}, {template}
+        while frontier:
+            frontier = {ref for key in frontier for ref in adjacency[key]} - reached
+            reached |= frontier
+        for key in reached:
+            reachers[key].add(template)
+    orphans = sorted(key for key in classes if key not in reachers)
+    broken = sorted({t for source, _, _ in dangling for t in reachers[source]})
+
+    report = {
+        "documents": len(classes),
+        "references": len(edges),
+        "dangling": dangling,
+        "broken_templates": broken,
+        "mismatched": mismatched,
+        "misfiled": misfiled,
+        "orphans": orphans,
+        "scanned": scanned.isoformat(),
+    }
+    log.info(
+        f"checked {len(edges)} references of {len(classes)} documents: "
+        f"{len(dangling)} dangling, {len(mismatched)} mismatched, "
+        f"{len(misfiled)} misfiled, {len(orphans)} orphans"
+    )
+    return report
+
+
+def repair(report, gc=False, batch_size=1000):
+    """Repair what can be repaired in a report of :func:`check_integrity`.
+
+    Dangling references are re-pointed to the document of the same class that
+    holds the missing name as Name or in its Aliases, if there is exactly one.
+    The other dangling references are left for a re-import of the broken
+    templates. The DateModified of the repaired documents is updated, so that
+    mirrors pick up the repairs (see :mod:`umitemplatedb.sync`).
+
+    Args:
+        report (dict): The report.
+        gc (bool): If True, also delete the orphans. Their deletion is
+            recorded for :mod:`umitemplatedb.sync`. Orphans modified since the
+            scan, or reachable from a document modified since the scan (e.g.
+            by an import running meanwhile) are kept. Refused if the report
+            has misfiled documents, whose references may be misread.
+        batch_size (int): Number of documents written per round trip.
+
+    Returns:
+        dict: "repointed", the repaired (source key, field path, new target
+            key) tuples, and "deleted", the keys of the deleted orphans.
+    """
+    if gc and report["misfiled"]:
+        raise ValueError("fix the misfiled documents before deleting orphans")
+    collection = mongodb_schema.UmiBase._get_collection()
+    targets = {target for _, _, target in report["dangling"]}
+    names = [target.split(", ", 1)[-1] for target in targets]
+    query = {"$or": [{"Name": {"$in": names}}, {"Aliases": {"$in": names}}]}
+    by_name = defaultdict(list)
+    for son in collection.find(query, {"Name": 1, "Aliases": 1}):
+        prefix = son["_id"].split(", ", 1)[0]
+        for name in {son.get("Name"), *son.get("Aliases", [])}:
+            by_name[f"{prefix}, {name}"].append(son["_id"])
+
+    # Bump DateModified so that mirrors pick up the repairs
+    now = datetime.utcnow()
+    repointed, requests = [], []
+    for source, path, target in report["dangling"]:
+        candidates = by_name.get(target, [])
+        if len(candidates) == 1:
+            update = {"$set": {path: candidates[0], "DateModified": now}}
+            requests.append(UpdateOne({"_id": source}, update))
+            repointed.append((source, path, candidates[0]))
+    _bulk_write(collection, requests, batch_size)
+    document_cache.invalidate(*{source for source, _, _ in repointed})
+
+    deleted = []
+    if gc and report["orphans"]:
+        deleted = _unused_since(report["orphans"], report["scanned"], batch_size)
+        _delete(deleted, batch_size)
+    if repointed or deleted:
+        from umitemplatedb.references import rebuild_index
+
+        rebuild_index(batch_size=batch_size)
+    log.info(
+        f"re-pointed {len(repointed)} dangling references, deleted "
+        f"{len(deleted)} orphans"
+    )
+    return {"repointed": repointed, "deleted": deleted}
+
+
+def _key_class(prefix):
+    """Return the UmiBase class named prefix, or None."""
+    try:
+        return get_document(f"UmiBase.{prefix}")
+    except NotRegistered:
+        return None
+
+
+def _unused_since(orphans, scanned, batch_size):
+    """Return the orphans still unused by the documents modified since the
+    scan, and not modified themselves."""
+    from umitemplatedb.graph import fetch_graph
+
+    collection = mongodb_schema.UmiBase._get_collection()
+    modified = {"DateModified": {"$gte": datetime.fromisoformat(scanned)}}
+    roots = [son["_id"] for son in collection.find(modified, {})]
+    used = set(fetch_graph(roots, batch_size=batch_size))
+    unused = [key for key in orphans if key not in used]
+    if len(unused) < len(orphans):
+        log.info(f"kept {len(orphans) - len(unused)} orphans used since the scan")
+    return unused
+
+
+def _delete(keys, batch_size):
+    """Delete documents and record their tombstones."""
+    collection = mongodb_schema.UmiBase._get_collection()
+    for i in range(0, len(keys), batch_size):
+        chunk = keys[i : i + batch_size]
+        collection.delete_many({"_id": {"$in": chunk}})
+        mongodb_schema.Tombstone.record(chunk)
+    document_cache.invalidate(*keys)
+
+
+def _bulk_write(collection, requests, batch_size):
+    for i in range(0, len(requests), batch_size):
+        collection.bulk_write(requests[i : i + batch_size], ordered=False)
@@ -0,0 +1,320 @@
+"""Concurrent load testing of the query and export paths.
+
+:func:`run` replays a weighted mix of operations from many concurrent
+clients (threads sharing the mongoengine connection pool, like the workers of
+:mod:`umitemplatedb.server`) and reports the throughput and the latency
+percentiles of each operation type.
+
+The operations are:
+
+- "catalog": a catalog query with a random metadata filter;
+- "geo": a catalog query of the templates containing a random point (needs a
+  real MongoDB: mongomock does not implement geo queries);
+- "facets": a read of the facet counts;
+- "fetch": a batched fetch of the reference graph of a random template;
+- "export": a conversion of a random template with
+  :meth:`BuildingTemplate.to_template`.
+
+Run it against mongomock to profile the package alone, or against a local
+mongod to find connection-pool limits (set the pool size in the URI, e.g.
+`mongodb://localhost/?maxPoolSize=10`). The database can be seeded from a
+library file with :func:`~umitemplatedb.core.import_umitemplate` and grown
+with :func:`synthesize`.
+
+Example:
+    >>> from umitemplatedb.loadtest import format_report, run, synthesize
+    >>> synthesize(1000)
+    >>> print(format_report(run({"catalog": 5, "export": 1}, clients=16)))
+"""
+import logging
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+#: The operation types.
+OPERATIONS = ("catalog", "geo", "facets", "fetch", "export")
+
+#: Default mix of operations, as relative weights.
+DEFAULT_MIX = {"catalog": 5, "facets": 2, "fetch": 2, "export": 1, "geo": 1}
+
+#: Countries of the synthetic templates.
+SYNTHETIC_COUNTRIES = ("CAN", "USA", "FRA", "DEU", "BEL", "ITA", "ESP", "CHE")
+
+#: BuildingTemplate fields derived from the geometry of its countries.
+GEOMETRY_FIELDS = ("CountryGeometries", "BoundingBox", "Footprint")
+
+
+def synthesize(n, seed=0, batch_size=1000):
+    """Add n synthetic BuildingTemplates to the database.
+
+    The synthetic templates are copies of the existing templates (which must
+    have been imported first) with random metadata. They share the components
+    of the templates they copy, like the templates of a real library, and
+    reference the geometry of their random country, so that they are found by
+    geo lookups. The
+    reverse-reference index and the facet counts are rebuilt afterwards.
+
+    Args:
+        n (int): Number of templates to add.
+        seed (int): Seed of the random metadata.
+        batch_size (int): Number of templates written per round trip.
+
+    Returns:
+        list of str: The keys of the added templates.
+    """
+    from umitemplatedb.facets import rebuild_facets
+    from umitemplatedb.mongodb_schema import BuildingTemplate, CountryGeometry
+    from umitemplatedb.references import rebuild_index
+    from umitemplatedb.storage import MongoStore
+
+    rng = random.Random(seed)
+    collection = BuildingTemplate._get_collection()
+    originals = list(collection.find(BuildingTemplate.objects()._query))
+    if not originals:
+        raise ValueError("import a library before synthesizing templates")
+    geometries = {}
+
+    def geometry(code):
+        """Return the geometry fields of a template of the country code."""
+        if code not in geometries:
+            template = BuildingTemplate(Country=[code])
+            template.set_geometry(get_country=CountryGeometry.get)
+            geometries[code] = {
+                name: value
+                for name, value in template.to_mongo().items()
+                if name in GEOMETRY_FIELDS
+            }
+        return geometries[code]
+
+    store, batch, keys = MongoStore(), [], []
+    for i in range(n):
+        son = dict(rng.choice(originals))
+        for field in ("Polygon", "MultiPolygon", *GEOMETRY_FIELDS):
+            son.pop(field, None)
+        year = rng.randrange(1900, 2020)
+        code = rng.choice(SYNTHETIC_COUNTRIES)
+        son.update(
+            geometry(code),
+            _id=f"BuildingTemplate, Synthetic {seed}-{i}",
+            Name=f"Synthetic {seed}-{i}",
+            Country=[code],
+            YearFrom=year,
+            YearTo=year + rng.randrange(1, 30),
+            DateModified=datetime.utcnow(),
+        )
+        batch.append(son)
+        keys.append(son["_id"])
+        if len(batch) >= batch_size:
+            store.put_many(batch)
+            batch = []
+    store.put_many(batch)
+    rebuild_index(batch_size=batch_size)
+    rebuild_facets(batch_size=batch_size)
+    log.info(f"added {n} synthetic templates")
+    return keys
+
+
+class _Operations(object):
+    """The operations of a load test, sharing the list of template keys."""
+
+    def __init__(self):
+        from umitemplatedb.mongodb_schema import BuildingTemplate
+
+        self.templates = list(
+            BuildingTemplate.objects().only("key", "Country", "BoundingBox")
+        )
+        if not self.templates:
+            raise ValueError("the database has no BuildingTemplate")
+
+    def catalog(self, rng):
+        from umitemplatedb.server import catalog
+
+        template = rng.choice(self.templates)
+        if template.Country and rng.random() < 0.5:
+            return catalog(Country=rng.choice(template.Country))
+        return catalog(YearFrom__gte=rng.randrange(1900, 2020))
+
+    def geo(self, rng):
+        from umitemplatedb.server import TemplateServer, catalog
+
+        box = rng.choice(self.templates).BoundingBox or [-180, -90, 180, 90]
+        point = {
+            "type": "Point",
+            "coordinates": [rng.uniform(box[0], box[2]), rng.uniform(box[1], box[3])],
+        }
+        return catalog(**TemplateServer.geo_filter(point))
+
+    def facets(self, rng):
+        from umitemplatedb.facets import facets
+
+        return facets()
+
+    def fetch(self, rng):
+        from umitemplatedb.cache import document_cache
+        from umitemplatedb.graph import fetch_graph
+
+        key = rng.choice(self.templates).key
+        return fetch_graph([key], get_many=document_cache.get_many)
+
+    def export(self, rng):
+        from umitemplatedb.cache import document_cache
+        from umitemplatedb.graph import fetch_graph, materialize
+
+        key = rng.choice(self.templates).key
+        docs = fetch_graph([key], get_many=document_cache.get_many)
+        return materialize(key, docs).to_template()
+
+
+def percentile(values, p):
+    """Return the p-th percentile (0-100) of sorted values, by nearest rank."""
+    if not values:
+        return None
+    rank = max(math.ceil(p / 100 * len(values)) - 1, 0)
+    return values[rank]
+
+
+def run(mix=None, clients=8, duration=10.0, requests=None, seed=0, warmup=True):
+    """Run a load test and return its report.
+
+    Args:
+        mix (dict): Relative weights of the operations, e.g.
+            `{"catalog": 5, "export": 1}`. Defaults to :data:`DEFAULT_MIX`.
+        clients (int): Number of concurrent clients (threads).
+        duration (float): Duration of the test, in seconds. Ignored if
+            `requests` is given.
+        requests (int): If given, each client runs this number of operations
+            instead of running for `duration`.
+        seed (int): Seed of the choice of the operations and their arguments.
+        warmup (bool): If True, each operation type runs once before the
+            measures, e.g. to fill the document cache.
+
+    Returns:
+        dict: "operations", mapping each operation type to its "count",
+            "errors", "throughput" (operations per second) and "p50", "p95",
+            "p99" and "max" latencies in milliseconds, plus the "total" count,
+            "elapsed" seconds, "throughput", "clients" and the statistics of
+            the document "cache". The first error of each type is reported in
+            "error".
+    """
+    from umitemplatedb.cache import document_cache
+
+    mix = dict(mix or DEFAULT_MIX)
+    unknown = [name for name in mix if name not in OPERATIONS]
+    if unknown:
+        raise ValueError(f"unknown operations {unknown}")
+    operations = _Operations()
+    names, weights = list(mix), [mix[name] for name in mix]
+
+    failed = {}
+    if warmup:
+        for name in names:
+            try:
+                getattr(operations, name)(random.Random(seed))
+            except Exception as e:
+                failed[name] = repr(e)
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    times = {}
+
+    def start_clock():
+        times["start"] = time.perf_counter()
+
+    barrier = threading.Barrier(clients, action=start_clock)
+
+    def client(index):
+        rng = random.Random(seed * 1000003 + index)
+        local, local_errors, first_errors = defaultdict(list), defaultdict(int), {}
+        barrier.wait()
+        deadline = times["start"] + duration
+        done = 0
+        while (
+            done < requests if requests is not None else time.perf_counter() < deadline
+        ):
+            name = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                getattr(operations, name)(rng)
+            except Exception as e:
+                local_errors[name] += 1
+                first_errors.setdefault(name, repr(e))
+            else:
+                local[name].append(time.perf_counter() - start)
+            done += 1
+        with lock:
+            for name, values in local.items():
+                latencies[name].extend(values)
+            for name, count in local_errors.items():
+                errors[name] += count
+            for name, error in first_errors.items():
+                failed.setdefault(name, error)
+
+    document_cache_stats = document_cache.stats()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - times["start"]
+
+    report = {"operations": {}}
+    for name in names:
+        values = sorted(latencies[name])
+        entry = {
+            "count": len(values),
+            "errors": errors[name],
+            "throughput": len(values) / elapsed,
+        }
+        for p in (50, 95, 99):
+            value = percentile(values, p)
+            entry[f"p{p}"] = None if value is None else value * 1000
+        entry["max"] = values[-1] * 1000 if values else None
+        if name in failed and errors[name]:
+            entry["error"] = failed[name]
+        report["operations"][name] = entry
+    total = sum(entry["count"] for entry in report["operations"].values())
+    after = document_cache.stats()
+    report.update(
+        total=total,
+        elapsed=elapsed,
+        throughput=total / elapsed,
+        clients=clients,
+        cache={
+            "hits": after["hits"] - document_cache_stats["hits"],
+            "misses": after["misses"] - document_cache_stats["misses"],
+            "evictions": after["evictions"] - document_cache_stats["evictions"],
+        },
+    )
+    return report
+
+
+def format_report(report):
+    """Format the report of a load test as a text table."""
+    lines = [
+        f"{'operation':<10}{'count':>8}{'errors':>8}{'ops/s':>10}"
+        f"{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}{'max (ms)':>10}"
+    ]
+
+    def ms(value):
+        return f"{'-':>10}" if value is None else f"{value:>10.1f}"
+
+    for name, entry in report["operations"].items():
+        lines.append(
+            f"{name:<10}{entry['count']:>8}{entry['errors']:>8}"
+            f"{entry['throughput']:>10.1f}{ms(entry['p50'])}{ms(entry['p95'])}"
+            f"{ms(entry['p99'])}{ms(entry['max'])}"
+        )
+    lines.append(
+        f"{report['total']} operations in {report['elapsed']:.1f} s from "
+        f"{report['clients']} clients: {report['throughput']:.1f} ops/s"
+    )
+    for name, entry in report["operations"].items():
+        if "error" in entry:
+            lines.append(f"{name} failed: {entry['error']}")
+    return "\n".join(lines)
@@ -1,8 +1,11 @@
+import hashlib
+import json
 import logging
 from datetime import datetime
 
 import geojson
 import pycountry
+from bson import DBRef
 from mongoengine import (
     BooleanField,
     DateTimeField,
@@ -11,16 +14,29 @@ from mongoengine import (
     EmbeddedDocumentListField,
     FloatField,
     IntField,
+    LazyReferenceField,
     ListField,
     MultiPolygonField,
     PolygonField,
+    QuerySet,
     ReferenceField,
     StringField,
     ValidationError,
 )
+from mongoengine.errors import DoesNotExist
 from pymongo import monitoring
 
 import archetypal.template
+from umitemplatedb import facets, references
+from umitemplatedb.cache import document_cache
+from umitemplatedb.geometry import (
+    bounding_box,
+    multipolygon_coordinates,
+    simplify,
+    union_bounding_box,
+)
+from umitemplatedb.graph import document_class, fetch_graph, resolve, unresolved_keys
+from umitemplatedb.profiling import profiler
 
 log = logging.getLogger(__name__)
 
@@ -61,29 +77,209 @@ class CompoundKey(EmbeddedDocument):
     meta = {"allow_inheritance": True, "strict": False}
 
 
+class CachedReferenceField(ReferenceField):
+    """A ReferenceField dereferenced through the
+    :data:`~umitemplatedb.cache.document_cache`.
+
+    Accessing a reference that is not loaded yet (e.g. `bldg.Core.Loads`) reads
+    the raw document from the cache, which only queries the database on a
+    miss.
+    """
+
+    def _lazy_load_ref(self, ref_cls, dbref):
+        (son,) = document_cache.get_many([dbref.id]) or [None]
+        if son is None:
+            raise DoesNotExist(f"Trying to dereference unknown document {dbref}")
+        return document_class(son, default=ref_cls)._from_son(son)
+
+
+class CachedReferenceListField(ListField):
+    """A ListField of :class:`CachedReferenceField`, dereferenced in one call
+    to the :data:`~umitemplatedb.cache.document_cache`."""
+
+    def __init__(self, document_type, **kwargs):
+        super().__init__(CachedReferenceField(document_type), **kwargs)
+
+    def _lazy_load_refs(self, instance, name, ref_values, *, max_depth):
+        keys = [ref.id for ref in ref_values if isinstance(ref, DBRef)]
+        if keys:
+            docs = {son["_id"]: son for son in document_cache.get_many(keys)}
+            default = self.field.document_type
+
+            def load(ref):
+                son = docs.get(ref.id) if isinstance(ref, DBRef) else None
+                if son is None:
+                    return ref  # left to mongoengine, which raises if missing
+                return document_class(son, default)._from_son(son)
+
+            ref_values = [load(ref) for ref in ref_values]
+        return super()._lazy_load_refs(
+            instance=instance, name=name, ref_values=ref_values, max_depth=max_depth
+        )
+
+
+class UmiBaseQuerySet(QuerySet):
+    """QuerySet deleting documents one by one, so that each deletion leaves a
+    :class:`Tombstone` and updates the derived data like
+    :meth:`UmiBase.delete`."""
+
+    def delete(self, *args, **kwargs):
+        count = 0
+        for document in self.clone():
+            document.delete()
+            count += 1
+        return count
+
+
 class UmiBase(Document):
     """The Base class of all Umi objects.
 
+    By default, the key of a document is "<ClassName>, <Name>". Set
+    :attr:`content_addressed` to True to key components on a hash of their
+    content instead: identical components are then stored once whatever their
+    name, and components sharing a name no longer overwrite each other. The
+    names under which a component was saved are kept in :attr:`Aliases`.
+    BuildingTemplates are always keyed on their name.
+
+    A content-addressed component cannot be edited in place: its edited content
+    has another key, while the documents referencing it still hold the old
+    one. :meth:`save` refuses to change the key of a loaded component. To store
+    an edited copy, set its key to None, save it and update the references.
+
     Attributes:
         Comments (StringField): Human readable string describing the exception.
         DataSource (StringField): Error code.
         Name (StringField): The Name of the Component. Required Field
         Category (StringField):
+        Aliases (ListField): Other names of a content-addressed component.
+        DateModified (DateTimeField): Time of the last save, in UTC. Used by
+            :func:`umitemplatedb.sync.changes_since`.
 
     """
 
+    #: Key components on a hash of their content instead of their name.
+    content_addressed = False
+
+    #: Fields describing a component, which are not part of its content hash.
+    _descriptive_fields = (
+        "_id",
+        "Name",
+        "Aliases",
+        "Category",
+        "Comments",
+        "DataSource",
+        "DateModified",
+    )
+
     key = StringField(primary_key=True)
 
     Name = StringField(required=True)
     Comments = StringField(null=True)
     DataSource = StringField(null=True)
     Category = StringField(default="Uncategorized")
+    Aliases = ListField(StringField())
+    DateModified = DateTimeField(default=datetime.utcnow)
 
-    meta = {"allow_inheritance": True}
+    meta = {
+        "allow_inheritance": True,
+        "indexes": ["Aliases", "DateModified"],
+        "queryset_class": UmiBaseQuerySet,
+    }
+
+    def make_key(self):
+        """Return the primary key of the document.
+
+        The key is "<ClassName>, <Name>", or "<ClassName>, <hash>" for
+        content-addressed components.
+        """
+        if self.content_addressed and not isinstance(self, BuildingTemplate):
+            return ", ".join([type(self).__name__, self.content_hash()])
+        return ", ".join([type(self).__name__, self.Name])
+
+    def content_hash(self):
+        """Return the SHA-1 of the normalized fields and references.
+
+        Descriptive fields (Name, Category, Comments, DataSource) are
+        excluded. References are hashed through the key of the referenced
+        documents, which are themselves content hashes when they were saved
+        content-addressed.
+        """
+        son = {
+            k: v
+            for k, v in self.to_mongo().items()
+            if k not in self._descriptive_fields
+        }
+        data = json.dumps(_normalize(son), sort_keys=True, separators=(",", ":"))
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def merge_aliases(self, existing):
+        """Keep the name of an existing document with the same key as alias.
+
+        The first name a component was saved with stays its Name; the others
+        are added to its Aliases.
+
+        Args:
+            existing (dict): The raw document stored under the same key, or
+                None.
+        """
+        if existing is None:
+            return
+        name = existing.get("Name") or self.Name
+        aliases = list(existing.get("Aliases", []))
+        for alias in (self.Name, *self.Aliases):
+            if alias not in aliases and alias != name:
+                aliases.append(alias)
+        self.Name = name
+        self.Aliases = aliases
 
     def save(self, *args, **kwargs):
-        self.key = ", ".join([type(self).__name__, self.Name])
-        return super(UmiBase, self).save(*args, **kwargs)
+        key = self.make_key()
+        if self.key is not None and key != self.key and self.content_addressed:
+            if not isinstance(self, BuildingTemplate):
+                raise ValueError(
+                    f"the content of '{self.key}' changed: saving it would create "
+                    f"a new component that its referrers do not use. Set its key "
+                    f"to None to save an edited copy"
+                )
+        if key != self.key:
+            # A new key is a new document: write it whole. Setting the key
+            # resets _created, so set it first.
+            self.key = key
+            self._created = True
+        self.DateModified = datetime.utcnow()
+        if self.content_addressed:
+            collection = self._get_collection()
+            self.merge_aliases(
+                collection.find_one({"_id": key}, {"Name": 1, "Aliases": 1})
+            )
+        if kwargs.pop("validate", True):
+            with profiler.phase("save.validate"):
+                self.validate(clean=kwargs.get("clean", True))
+        with profiler.phase("save.write"):
+            document = super(UmiBase, self).save(*args, validate=False, **kwargs)
+        document_cache.invalidate(self.key)
+        with profiler.phase("save.references"):
+            references.on_save(self)
+        return document
+
+    def delete(self, *args, **kwargs):
+        super(UmiBase, self).delete(*args, **kwargs)
+        Tombstone(key=self.key).save()
+        document_cache.invalidate(self.key)
+        references.on_delete(self)
+
+
+def _normalize(value):
+    """Normalize a raw value for hashing. Floats are rounded to 12 digits."""
+    if isinstance(value, float):
+        return float(f"{value:.12g}")
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
 
 
 class Material(UmiBase):
@@ -149,14 +345,14 @@ class _Layer(EmbeddedDocument):
 
 
 class MaterialLayer(_Layer):
-    Material = ReferenceField(Material, required=True)
+    Material = CachedReferenceField(Material, required=True)
     Thickness = FloatField(required=True)
 
     meta = {"allow_inheritance": True, "strict": False}
 
 
 class GasLayer(_Layer):
-    Material = ReferenceField(GasMaterial, required=True)
+    Material = CachedReferenceField(GasMaterial, required=True)
     Thickness = FloatField(required=True)
 
     meta = {"allow_inheritance": True, "strict": False}
@@ -184,7 +380,7 @@ class WindowConstruction(ConstructionBase):
 
 class MassRatio(EmbeddedDocument):
     HighLoadRatio = FloatField(default=0.0)
-    Material = ReferenceField(OpaqueMaterial, required=True)
+    Material = CachedReferenceField(OpaqueMaterial, required=True)
     NormalRatio = FloatField(default=0.0)
 
     meta = {"allow_inheritance": True, "strict": False}
@@ -208,7 +404,7 @@ def min_length(x):
 
 
 class WeekSchedule(UmiBase):
-    Days = ListField(ReferenceField(DaySchedule), validation=min_length, required=True)
+    Days = CachedReferenceListField(DaySchedule, validation=min_length, required=True)
     Type = StringField(default="Fraction")
 
 
@@ -217,7 +413,7 @@ class YearSchedulePart(EmbeddedDocument):
     FromMonth = IntField(min_value=1, max_value=12)
     ToDay = IntField(min_value=1, max_value=31)
     ToMonth = IntField(min_value=1, max_value=12)
-    Schedule = ReferenceField(WeekSchedule, required=True)
+    Schedule = CachedReferenceField(WeekSchedule, required=True)
 
     meta = {"allow_inheritance": True, "strict": False}
 
@@ -230,7 +426,7 @@ class YearSchedule(UmiBase):
 class DomesticHotWaterSetting(UmiBase):
     FlowRatePerFloorArea = FloatField(default=0.03)
     IsOn = BooleanField(default=True)
-    WaterSchedule = ReferenceField(YearSchedule, required=True)
+    WaterSchedule = CachedReferenceField(YearSchedule, required=True)
     WaterSupplyTemperature = FloatField(default=65)
     WaterTemperatureInlet = FloatField(default=10)
 
@@ -245,16 +441,16 @@ class VentilationSetting(UmiBase):
     NatVentMaxRelHumidity = FloatField(default=90, min_value=0, max_value=100)
     NatVentMaxOutdoorAirTemp = FloatField(default=30)
     NatVentMinOutdoorAirTemp = FloatField(default=0)
-    NatVentSchedule = ReferenceField(YearSchedule, required=True)
+    NatVentSchedule = CachedReferenceField(YearSchedule, required=True)
     NatVentZoneTempSetpoint = FloatField(default=18)
     ScheduledVentilationAch = FloatField(default=0.6)
-    ScheduledVentilationSchedule = ReferenceField(YearSchedule, required=True)
+    ScheduledVentilationSchedule = CachedReferenceField(YearSchedule, required=True)
     ScheduledVentilationSetpoint = FloatField(default=18)
     IsWindOn = BooleanField(default=False)
 
 
 class ZoneConditioning(UmiBase):
-    CoolingSchedule = ReferenceField(YearSchedule, required=True)
+    CoolingSchedule = CachedReferenceField(YearSchedule, required=True)
     CoolingCoeffOfPerf = FloatField()
     CoolingSetpoint = FloatField(default=26)
     CoolingLimitType = IntField()
@@ -263,7 +459,7 @@ class ZoneConditioning(UmiBase):
     HeatingCoeffOfPerf = FloatField()
     HeatingLimitType = IntField()
     HeatingFuelType = IntField(required=True)
-    HeatingSchedule = ReferenceField(YearSchedule, required=True)
+    HeatingSchedule = CachedReferenceField(YearSchedule, required=True)
     HeatingSetpoint = FloatField(default=20)
     HeatRecoveryEfficiencyLatent = FloatField(min_value=0, max_value=1, default=0.65)
     HeatRecoveryEfficiencySensible = FloatField(min_value=0, max_value=1, default=0.7)
@@ -275,17 +471,17 @@ class ZoneConditioning(UmiBase):
     MaxCoolingCapacity = FloatField(default=100)
     MaxHeatFlow = FloatField(default=100)
     MaxHeatingCapacity = FloatField(default=100)
-    MechVentSchedule = ReferenceField(YearSchedule, required=True)
+    MechVentSchedule = CachedReferenceField(YearSchedule, required=True)
     MinFreshAirPerArea = FloatField(default=0.001)
     MinFreshAirPerPerson = FloatField(default=0.001)
 
 
 class ZoneConstructionSet(UmiBase):
-    Facade = ReferenceField(OpaqueConstruction, required=True)
-    Ground = ReferenceField(OpaqueConstruction, required=True)
-    Partition = ReferenceField(OpaqueConstruction, required=True)
-    Roof = ReferenceField(OpaqueConstruction, required=True)
-    Slab = ReferenceField(OpaqueConstruction, required=True)
+    Facade = CachedReferenceField(OpaqueConstruction, required=True)
+    Ground = CachedReferenceField(OpaqueConstruction, required=True)
+    Partition = CachedReferenceField(OpaqueConstruction, required=True)
+    Roof = CachedReferenceField(OpaqueConstruction, required=True)
+    Slab = CachedReferenceField(OpaqueConstruction, required=True)
     IsFacadeAdiabatic = BooleanField(default=False)
     IsGroundAdiabatic = BooleanField(default=False)
     IsPartitionAdiabatic = BooleanField(default=False)
@@ -295,12 +491,12 @@ class ZoneConstructionSet(UmiBase):
 
 class ZoneLoad(UmiBase):
     DimmingType = IntField()
-    EquipmentAvailabilitySchedule = ReferenceField(YearSchedule, required=True)
+    EquipmentAvailabilitySchedule = CachedReferenceField(YearSchedule, required=True)
     EquipmentPowerDensity = FloatField(default=12)
     IlluminanceTarget = FloatField(default=500)
     LightingPowerDensity = FloatField(default=12)
-    LightsAvailabilitySchedule = ReferenceField(YearSchedule, required=True)
-    OccupancySchedule = ReferenceField(YearSchedule, required=True)
+    LightsAvailabilitySchedule = CachedReferenceField(YearSchedule, required=True)
+    OccupancySchedule = CachedReferenceField(YearSchedule, required=True)
     IsEquipmentOn = BooleanField(default=True)
     IsLightingOn = BooleanField(default=True)
     IsPeopleOn = BooleanField(default=True)
@@ -308,15 +504,15 @@ class ZoneLoad(UmiBase):
 
 
 class ZoneDefinition(UmiBase):
-    Conditioning = ReferenceField(ZoneConditioning, required=True)
-    Constructions = ReferenceField(ZoneConstructionSet, required=True)
+    Conditioning = CachedReferenceField(ZoneConditioning, required=True)
+    Constructions = CachedReferenceField(ZoneConstructionSet, required=True)
     DaylightMeshResolution = FloatField(default=1)
     DaylightWorkplaneHeight = FloatField(default=0.8)
-    DomesticHotWater = ReferenceField(DomesticHotWaterSetting, required=True)
-    InternalMassConstruction = ReferenceField(OpaqueConstruction, required=True)
+    DomesticHotWater = CachedReferenceField(DomesticHotWaterSetting, required=True)
+    InternalMassConstruction = CachedReferenceField(OpaqueConstruction, required=True)
     InternalMassExposedPerFloorArea = FloatField()
-    Loads = ReferenceField(ZoneLoad, required=True)
-    Ventilation = ReferenceField(VentilationSetting, required=True)
+    Loads = CachedReferenceField(ZoneLoad, required=True)
+    Ventilation = CachedReferenceField(VentilationSetting, required=True)
 
     zone_surfaces = ListField()
     is_part_of_conditioned_floor_area = BooleanField(default=True)
@@ -331,18 +527,20 @@ class ZoneDefinition(UmiBase):
 class WindowSetting(UmiBase):
     AfnDischargeC = FloatField(default=0.65, min_value=0, max_value=1)
     AfnTempSetpoint = FloatField(default=20)
-    AfnWindowAvailability = ReferenceField(YearSchedule, required=True)
-    Construction = ReferenceField(WindowConstruction, required=True)
+    AfnWindowAvailability = CachedReferenceField(YearSchedule, required=True)
+    Construction = CachedReferenceField(WindowConstruction, required=True)
     IsShadingSystemOn = BooleanField(default=True)
     IsVirtualPartition = BooleanField()
     IsZoneMixingOn = BooleanField()
     OperableArea = FloatField(default=0.8, min_value=0, max_value=1)
-    ShadingSystemAvailabilitySchedule = ReferenceField(YearSchedule, required=True)
+    ShadingSystemAvailabilitySchedule = CachedReferenceField(
+        YearSchedule, required=True
+    )
     ShadingSystemSetpoint = FloatField(default=180)
     ShadingSystemTransmittance = FloatField(default=0.5)
     ShadingSystemType = IntField()
     Type = IntField()
-    ZoneMixingAvailabilitySchedule = ReferenceField(YearSchedule, required=True)
+    ZoneMixingAvailabilitySchedule = CachedReferenceField(YearSchedule, required=True)
     ZoneMixingDeltaTemperature = FloatField(default=2.0)
     ZoneMixingFlowRate = FloatField(default=0.001)
 
@@ -363,56 +561,243 @@ class ClimateZone(Document):
     geometry = PolygonField()
 
 
+class CountryGeometry(Document):
+    """The geometry of a country, stored once and referenced by the
+    BuildingTemplates of this country.
+
+    Attributes:
+        ISO3_CODE (StringField): The ISO 3166-1 alpha-3 code of the country.
+        Name (StringField): The name of the country.
+        geometry (MultiPolygonField): The full geometry.
+        BoundingBox (ListField): [min lon, min lat, max lon, max lat].
+        Footprint (MultiPolygonField): The geometry simplified with a tolerance
+            of :data:`~umitemplatedb.geometry.FOOTPRINT_TOLERANCE`.
+    """
+
+    ISO3_CODE = StringField(primary_key=True)
+    Name = StringField()
+    geometry = MultiPolygonField()
+    BoundingBox = ListField(FloatField())
+    Footprint = MultiPolygonField()
+
+    @classmethod
+    def from_geometry(cls, code, geometry, **kwargs):
+        """Create a CountryGeometry from a GeoJSON-like Polygon or MultiPolygon.
+
+        The bounding box and footprint are computed. The document is not saved.
+        """
+        coordinates = multipolygon_coordinates(geometry)
+        footprint = simplify(coordinates)
+        return cls(
+            ISO3_CODE=code,
+            geometry={"type": "MultiPolygon", "coordinates": coordinates},
+            BoundingBox=bounding_box(coordinates) or [],
+            Footprint={"type": "MultiPolygon", "coordinates": footprint}
+            if footprint
+            else None,
+            **kwargs,
+        )
+
+    @classmethod
+    def from_country(cls, code):
+        """Create the CountryGeometry of code from the geo-countries dataset.
+
+        The document is not saved. Returns None if the country is not found.
+        """
+        feature = next(
+            filter(
+                lambda x: x["properties"]["ISO_A3"] == code,
+                BuildingTemplate.load_geo_countries(),
+            ),
+            None,
+        )
+        if feature is None:
+            return None
+        return cls.from_geometry(
+            code, feature["geometry"], Name=feature["properties"].get("ADMIN")
+        )
+
+    @classmethod
+    def get(cls, code):
+        """Return the CountryGeometry of code, without its full geometry.
+
+        It is created from the geo-countries dataset and saved if needed.
+        Returns None if the country is not found.
+        """
+        country = cls.objects(ISO3_CODE=code).exclude("geometry").first()
+        if country is None:
+            country = cls.from_country(code)
+            if country is not None:
+                country.save()
+        return country
+
+
+class ReferenceIndex(Document):
+    """Reverse references of a component. Maintained by
+    :mod:`umitemplatedb.references`.
+
+    Attributes:
+        key (StringField): The key of the referenced component.
+        referrers (ListField): Keys of the documents referencing it directly.
+        templates (ListField): Keys of the BuildingTemplates reaching it.
+    """
+
+    key = StringField(primary_key=True)
+    referrers = ListField(StringField())
+    templates = ListField(StringField())
+
+    meta = {"indexes": ["referrers", "templates"]}
+
+
+class FacetCount(Document):
+    """Number of BuildingTemplates having a value of a facet. Maintained by
+    :mod:`umitemplatedb.facets`.
+
+    Attributes:
+        key (StringField): "<facet>=<value>".
+        facet (StringField): The name of the facet, e.g. "Country".
+        value (StringField): The value, e.g. "FRA", or the bucket of years.
+        count (IntField): The number of templates.
+    """
+
+    key = StringField(primary_key=True)
+    facet = StringField(required=True)
+    value = StringField(required=True)
+    count = IntField(default=0)
+
+    meta = {"indexes": ["facet", "count"]}
+
+
+class Tombstone(Document):
+    """Record of a deleted UmiBase document, so that mirrors synchronized with
+    :func:`umitemplatedb.sync.changes_since` delete it too.
+
+    Attributes:
+        key (StringField): The key of the deleted document.
+        DateDeleted (DateTimeField): Time of the deletion, in UTC.
+    """
+
+    key = StringField(primary_key=True)
+    DateDeleted = DateTimeField(default=datetime.utcnow)
+
+    meta = {"indexes": ["DateDeleted"]}
+
+    @classmethod
+    def record(cls, keys):
+        """Record the deletion of the documents of keys, in one round trip."""
+        from pymongo import ReplaceOne
+
+        now = datetime.utcnow()
+        requests = [
+            ReplaceOne({"_id": key}, {"_id": key, "DateDeleted": now}, upsert=True)
+            for key in keys
+        ]
+        if requests:
+            cls._get_collection().bulk_write(requests, ordered=False)
+
+
+class StoreMeta(Document):
+    """A named value saved by :meth:`umitemplatedb.storage.MongoStore.set_meta`,
+    e.g. the sync token of a mirror.
+
+    Attributes:
+        name (StringField): The name of the value.
+        value (StringField): The value.
+    """
+
+    name = StringField(primary_key=True)
+    value = StringField()
+
+
+class ImportCheckpoint(Document):
+    """Progress of an import. Used by :func:`umitemplatedb.core.import_umitemplate`
+    to resume an interrupted import.
+
+    Attributes:
+        key (StringField): Hash of the imported file and of the metadata.
+        filename (StringField): The imported file.
+        completed (ListField): Names of the BuildingTemplates already imported.
+        finished (BooleanField): True once all the templates are imported.
+    """
+
+    key = StringField(primary_key=True)
+    filename = StringField()
+    completed = ListField(StringField())
+    finished = BooleanField(default=False)
+    DateCreated = DateTimeField(default=datetime.utcnow)
+    DateModified = DateTimeField(default=datetime.utcnow)
+
+
 class BuildingTemplate(UmiBase):
     """Top most object in Umi Template Structure"""
 
     _geo_countries = None
     _available_countries = tuple((a.alpha_3, a.name) for a in list(pycountry.countries))
 
-    Core = ReferenceField(ZoneDefinition, required=True)
+    Core = CachedReferenceField(ZoneDefinition, required=True)
     Lifespan = IntField(default=60)
     PartitionRatio = FloatField(default=0)
-    Perimeter = ReferenceField(ZoneDefinition, required=True)
-    Structure = ReferenceField(StructureInformation, required=True)
-    Windows = ReferenceField(WindowSetting, required=True)
+    Perimeter = CachedReferenceField(ZoneDefinition, required=True)
+    Structure = CachedReferenceField(StructureInformation, required=True)
+    Windows = CachedReferenceField(WindowSetting, required=True)
     DefaultWindowToWallRatio = FloatField(default=0.4, min_value=0, max_value=1)
 
     # MetaData
     Authors = ListField(StringField())
     AuthorEmails = ListField(StringField())
     DateCreated = DateTimeField(default=datetime.utcnow, required=True)
-    DateModified = DateTimeField(default=datetime.utcnow)
     Country = ListField(StringField(choices=_available_countries))
     YearFrom = IntField(help_text="Template starting year")
     YearTo = IntField(help_text="End year")
     ClimateZone = ListField(StringField())
     Polygon = PolygonField()
     MultiPolygon = MultiPolygonField()
+    CountryGeometries = ListField(LazyReferenceField(CountryGeometry))
+    BoundingBox = ListField(FloatField())
+    Footprint = MultiPolygonField()
     Description = StringField()
     Version = StringField()
 
-    def to_template(self, idf=None, bar=None):
+    def to_template(self, idf=None, bar=None, memo=None):
         """Converts to an :class:~`archetypal.template.building_template
         .BuildingTemplate` object.
 
+        The referenced components are fetched beforehand with one batched query
+        per level of the reference graph, through the read-through
+        :data:`~umitemplatedb.cache.document_cache`.
+
+        No IDF is needed to create template objects from their values. If an
+        IDF is given, it is passed to every created object; reuse the same one
+        for a whole export session.
+
         Args:
             idf (IDF): Optional, an IDF object.
             bar (tqdm): A tqdm progress bar, optional.
+            memo (dict): Optional dict of the template objects already
+                converted, keyed on :attr:`UmiBase.key`. Components shared by
+                several templates are then converted once and shared by the
+                returned objects. Updated in place.
 
         Returns:
             (archetypal.template.BuildingTemplate): The BuildingTemplate object.
         """
+        if memo is None:
+            memo = {}
+        kwargs = {} if idf is None else {"idf": idf}
 
-        def recursive(document, idf, bar):
+        def recursive(document, bar):
             """recursively create UmiBase objects from Document objects. Start with
             BuildingTemplates."""
+            is_component = isinstance(document, UmiBase)
+            if is_component and document.key in memo:
+                return memo[document.key]
             if bar is not None:
                 bar.update(1)
             instance_attr = {}
             class_ = getattr(archetypal.template, type(document).__name__)
             for key in document:
                 if isinstance(document[key], (UmiBase, YearSchedulePart)):
-                    instance_attr[key] = recursive(document[key], idf, bar)
+                    instance_attr[key] = recursive(document[key], bar)
                 elif isinstance(document[key], list):
                     instance_attr[key] = []
                     for value in document[key]:
@@ -426,44 +811,120 @@ class BuildingTemplate(UmiBase):
                                 MassRatio,
                             ),
                         ):
-                            instance_attr[key].append(recursive(value, idf, bar))
+                            instance_attr[key].append(recursive(value, bar))
                         else:
                             instance_attr[key].append(value)
                 elif isinstance(document[key], (str, int, float)):
                     instance_attr[key] = document[key]
-            class_instance = class_(**instance_attr, idf=idf)
+            class_instance = class_(**instance_attr, **kwargs)
+            if is_component and document.key is not None:
+                memo[document.key] = class_instance
             return class_instance
 
-        if idf is None:
-            from archetypal import IDF
+        self.prefetch()
+        return recursive(self, bar=bar)
 
-            idf = IDF()
-        return recursive(self, idf=idf, bar=bar)
+    def prefetch(self, get_many=None):
+        """Resolve all the references of the template graph in batch.
+
+        References that are not loaded yet are fetched with one query per
+        level of the graph instead of one query per dereferenced field. No
+        query is made if the graph is already resolved, e.g. for a template
+        returned by :meth:`~umitemplatedb.storage.SQLiteStore.get_template`.
+
+        Args:
+            get_many (callable): Returns the raw documents of a list of keys.
+                Defaults to :meth:`document_cache.get_many
+                <umitemplatedb.cache.DocumentCache.get_many>`, reading MongoDB.
+        """
+        keys = unresolved_keys(self)
+        if not keys:
+            return self
+        docs = fetch_graph(keys, get_many=get_many or document_cache.get_many)
+        return resolve(self, docs)
 
     def save(self, *args, **kwargs):
-        if not self.Polygon and self.Country:
-            geometry = next(
-                filter(
-                    lambda x: x["properties"]["ISO_A3"] in self.Country,
-                    self.geo_countries,
-                ),
-                None,
+        with profiler.phase("save.geometry"):
+            self.set_geometry()
+        previous = facets.stored_values(self.make_key())
+        document = super(BuildingTemplate, self).save(*args, **kwargs)
+        facets.on_save(self, previous)
+        return document
+
+    def delete(self, *args, **kwargs):
+        previous = facets.stored_values(self.key)
+        super(BuildingTemplate, self).delete(*args, **kwargs)
+        facets.on_delete(previous)
+
+    def set_geometry(self, get_country=None):
+        """Reference the geometries of the Countries and set the BoundingBox and
+        Footprint.
+
+        Country geometries are stored once, in :class:`CountryGeometry`. A
+        Polygon or MultiPolygon set explicitly is the geometry of the template
+        instead: no country geometry is then referenced.
+
+        Args:
+            get_country (callable): Returns the CountryGeometry of an ISO3
+                code, or None. Defaults to :meth:`CountryGeometry.get`.
+        """
+        explicit = self.Polygon or self.MultiPolygon
+        if explicit:
+            coordinates = multipolygon_coordinates(explicit)
+            footprint = simplify(coordinates)
+            self.CountryGeometries = []
+            self.BoundingBox = bounding_box(coordinates) or []
+            self.Footprint = (
+                {"type": "MultiPolygon", "coordinates": footprint} if footprint else None
             )
-            if geometry is not None:
-                geometry = geometry.geometry  # get actual geom
-                if isinstance(geometry, geojson.MultiPolygon):
-                    self.MultiPolygon = geometry  # set to MultiPolygon
-                elif isinstance(geometry, geojson.Polygon):
-                    self.Polygon = geometry  # set to Polygon
-                else:
-                    raise TypeError(
-                        f"cannot import geometry of type '{type(geometry)}'. "
-                        f"Only 'Polygon' and 'MultiPolygon' are supported"
-                    )
-        return super(BuildingTemplate, self).save(*args, **kwargs)
+            return
+        codes = list(self.Country or [])
+        if [ref.pk for ref in self.CountryGeometries] == codes and (
+            self.BoundingBox or not codes
+        ):
+            return  # already up to date
+        if get_country is None:
+            get_country = CountryGeometry.get
+        countries = [c for c in map(get_country, codes) if c is not None]
+        footprint = [
+            polygon
+            for country in countries
+            if country.Footprint
+            for polygon in country.Footprint["coordinates"]
+        ]
+        self.CountryGeometries = countries
+        self.BoundingBox = union_bounding_box(c.BoundingBox for c in countries) or []
+        self.Footprint = (
+            {"type": "MultiPolygon", "coordinates": footprint} if footprint else None
+        )
 
-    @property
-    def geo_countries(self):
+    def get_geometry(self):
+        """Return the full geometry of the template, or None.
+
+        Returns:
+            dict: The explicit Polygon or MultiPolygon of the template, or the
+                MultiPolygon of its countries, fetched from
+                :class:`CountryGeometry`.
+        """
+        explicit = self.Polygon or self.MultiPolygon
+        if explicit:
+            return explicit
+        codes = [ref.pk for ref in self.CountryGeometries]
+        coordinates = [
+            polygon
+            for country in CountryGeometry.objects(ISO3_CODE__in=codes)
+            for polygon in country.geometry["coordinates"]
+        ]
+        if not coordinates:
+            return None
+        return {"type": "MultiPolygon", "coordinates": coordinates}
+
+    @classmethod
+    def load_geo_countries(cls):
+        """Return the features of the geo-countries dataset from datahub.io.
+
+        The dataset is downloaded once per process.
+        """
         if BuildingTemplate._geo_countries is None:
             from datapackage import Package
 
@@ -481,4 +942,8 @@ class BuildingTemplate(UmiBase):
                 f = package.get_resource("countries").raw_read()
                 BuildingTemplate._geo_countries = geojson.loads(f).features
                 log.info("Country Polygons loaded from datahub.io")
-        return self._geo_countries
+        return BuildingTemplate._geo_countries
+
+    @property
+    def geo_countries(self):
+        return self.load_geo_countries()
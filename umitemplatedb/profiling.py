@@ -0,0 +1,294 @@
+"""Per-phase instrumentation of the import and export pipelines.
+
+The pipelines are divided in named phases (see :data:`PHASES`). When the
+:data:`profiler` is enabled, each phase records its number of calls, its
+cumulative wall time and, optionally, the memory it allocated (with
+:mod:`tracemalloc`) and the database commands it sent. When it is disabled, a
+phase is a shared no-op context manager: the pipelines pay one attribute
+lookup per phase.
+
+Phases nest: the time of a phase includes the time of the phases it contains
+(e.g. "save.write" is included in "import.convert"). Phases running in several
+threads at once add up their times.
+
+The profiler is enabled programmatically, by the `--profile` option of the
+command-line interface or by the `UMITEMPLATEDB_PROFILE` environment variable,
+read at import time. The variable is a comma-separated list of "time"
+(the default for any non-empty value), "memory", "commands" and "cprofile".
+If `UMITEMPLATEDB_PROFILE_OUTPUT` is set too, the report is written to that
+path when the process exits: a JSON report, or a cProfile dump if the path ends
+with ".prof", or a tracemalloc snapshot if it ends with ".tracemalloc".
+
+Example:
+    >>> from umitemplatedb.profiling import profiler
+    >>> profiler.enable(memory=True)
+    >>> import_umitemplate("BostonTemplateLibrary.json")
+    >>> profiler.report()["phases"]["import.open"]
+    {'calls': 1, 'seconds': 0.41, 'allocated': 10281342}
+    >>> profiler.dump("import.json")
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import nullcontext
+from functools import wraps
+
+from pymongo import monitoring
+
+log = logging.getLogger(__name__)
+
+#: The instrumented phases.
+PHASES = {
+    "import.checkpoint": "hashing the file and loading the import checkpoint",
+    "import.open": "parsing the file with UmiTemplateLibrary.open",
+    "import.convert": "converting the archetypal objects to Documents",
+    "save.geometry": "looking up the country geometry of a BuildingTemplate",
+    "save.validate": "validating a Document",
+    "save.write": "writing a Document to the database",
+    "save.references": "updating the reverse-reference index",
+    "export.query": "selecting the templates to export",
+    "export.fetch": "fetching the reference graphs of the templates",
+    "export.convert": "converting Documents to archetypal objects",
+    "export.merge": "merging the components converted by several workers",
+    "export.library": "collecting the components of the library",
+    "export.write": "serializing the library",
+    "index.ensure_indexes": "creating the database indexes",
+    "index.references": "rebuilding the reverse-reference index",
+    "index.facets": "recounting the facets of the catalog",
+    "loadtest.synthesize": "adding synthetic templates for a load test",
+    "migrate.geometries": "moving the country geometries to their collection",
+    "check.scan": "checking the references of all the documents",
+    "check.repair": "re-pointing dangling references and deleting orphans",
+}
+
+_NULL = nullcontext()
+
+
+class _CommandCounter(monitoring.CommandListener):
+    """A pymongo command listener counting the commands by name."""
+
+    def __init__(self):
+        self.commands = Counter()
+
+    def started(self, event):
+        self.commands[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+class _Phase(object):
+    """Context manager measuring one run of a phase."""
+
+    __slots__ = ("profiler", "name", "start", "memory", "commands")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        profiler = self.profiler
+        if profiler.memory:
+            import tracemalloc
+
+            self.memory = tracemalloc.get_traced_memory()[0]
+        if profiler._counter is not None:
+            self.commands = sum(profiler._counter.commands.values())
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        profiler = self.profiler
+        allocated = commands = None
+        if profiler.memory:
+            import tracemalloc
+
+            allocated = tracemalloc.get_traced_memory()[0] - self.memory
+        if profiler._counter is not None:
+            commands = sum(profiler._counter.commands.values()) - self.commands
+        profiler._record(self.name, seconds, allocated, commands)
+        return False
+
+
+class Profiler(object):
+    """Records the calls, wall time and memory of named phases.
+
+    Use the module-level :data:`profiler` rather than creating instances.
+
+    Attributes:
+        enabled (bool): Whether phases are measured.
+        memory (bool): Whether the memory allocated by each phase is measured.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.phases = {}
+        self._lock = threading.Lock()
+        self._counter = None
+        self._cprofile = None
+        self._started_tracing = False
+
+    def enable(self, memory=False, commands=False, cprofile=False):
+        """Start measuring the phases.
+
+        Args:
+            memory (bool): Also measure the net memory allocated by each phase
+                with :mod:`tracemalloc`, which slows Python down noticeably.
+            commands (bool): Also count the database commands sent during each
+                phase. Only connections opened after this call are monitored.
+            cprofile (bool): Also run :mod:`cProfile` for a function-level
+                profile, written by :meth:`dump` to a ".prof" path.
+        """
+        self.enabled = True
+        if memory and not self.memory:
+            import tracemalloc
+
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            self.memory = True
+        if commands and self._counter is None:
+            self._counter = _CommandCounter()
+            monitoring.register(self._counter)
+        if cprofile and self._cprofile is None:
+            import cProfile
+
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def disable(self):
+        """Stop measuring the phases. The recorded measures are kept.
+
+        Tracing of memory allocations is only stopped if :meth:`enable` started
+        it.
+        """
+        self.enabled = False
+        if self.memory:
+            import tracemalloc
+
+            if self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+            self.memory = False
+        if self._cprofile is not None:
+            self._cprofile.disable()
+
+    def reset(self):
+        """Forget the recorded measures."""
+        with self._lock:
+            self.phases.clear()
+            if self._counter is not None:
+                self._counter.commands.clear()
+
+    def phase(self, name):
+        """Return a context manager measuring the phase name.
+
+        Example:
+            >>> with profiler.phase("export.write"):
+            ...     library.to_json(filename)
+        """
+        if not self.enabled:
+            return _NULL
+        return _Phase(self, name)
+
+    def profiled(self, name):
+        """Decorator measuring each call of the function as the phase name."""
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _Phase(self, name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def _record(self, name, seconds, allocated=None, commands=None):
+        with self._lock:
+            stats = self.phases.get(name)
+            if stats is None:
+                stats = self.phases[name] = {"calls": 0, "seconds": 0.0}
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            if allocated is not None:
+                stats["allocated"] = stats.get("allocated", 0) + allocated
+            if commands is not None:
+                stats["round_trips"] = stats.get("round_trips", 0) + commands
+
+    def report(self):
+        """Return the recorded measures.
+
+        Returns:
+            dict: "phases", mapping phase names to their "calls", "seconds",
+                and, if measured, "allocated" bytes and database "round_trips";
+                "commands", the number of database commands by name, if
+                counted; "peak_memory", the peak traced memory in bytes, if
+                measured.
+        """
+        with self._lock:
+            report = {"phases": {k: dict(v) for k, v in self.phases.items()}}
+            if self._counter is not None:
+                report["commands"] = dict(self._counter.commands)
+        if self.memory:
+            import tracemalloc
+
+            report["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        return report
+
+    def dump(self, path):
+        """Write the measures to path.
+
+        The format depends on the extension of path: ".prof" writes the
+        cProfile statistics (see :mod:`pstats`), ".tracemalloc" writes a
+        :class:`tracemalloc.Snapshot`, anything else writes the JSON
+        :meth:`report`.
+        """
+        path = str(path)
+        if path.endswith(".prof"):
+            if self._cprofile is None:
+                raise ValueError("cProfile was not enabled")
+            self._cprofile.dump_stats(path)
+        elif path.endswith(".tracemalloc"):
+            import tracemalloc
+
+            if not self.memory:
+                raise ValueError("memory profiling was not enabled")
+            tracemalloc.take_snapshot().dump(path)
+        else:
+            with open(path, "w") as f:
+                json.dump(self.report(), f, indent=2)
+        log.info(f"profile written to {path}")
+
+
+#: The profiler of the pipelines.
+profiler = Profiler()
+
+
+def _enable_from_environment():
+    value = os.environ.get("UMITEMPLATEDB_PROFILE", "").strip().lower()
+    if not value or value in ("0", "false", "no", "off"):
+        return
+    options = {option.strip() for option in value.split(",")}
+    profiler.enable(
+        memory="memory" in options,
+        commands="commands" in options,
+        cprofile="cprofile" in options,
+    )
+    output = os.environ.get("UMITEMPLATEDB_PROFILE_OUTPUT")
+    if output:
+        atexit.register(profiler.dump, output)
+
+
+_enable_from_environment()
@@ -0,0 +1,179 @@
+"""Reverse-reference index of the template graph.
+
+For each component key, :class:`~umitemplatedb.mongodb_schema.ReferenceIndex`
+stores the keys of the documents referencing it directly (`referrers`) and the
+keys of the BuildingTemplates reaching it through the reference graph
+(`templates`). Answering "which BuildingTemplates use this OpaqueMaterial" is
+then a single primary-key lookup, whatever the number of templates.
+
+The index is maintained by :meth:`UmiBase.save` and :meth:`UmiBase.delete`.
+Documents written without going through mongoengine (e.g. with
+:meth:`~umitemplatedb.storage.MongoStore.put_many`) require a
+:func:`rebuild_index`.
+
+Example:
+    >>> from umitemplatedb.references import templates_using
+    >>> templates_using("YearSchedule, AlwaysOn")
+    ['BuildingTemplate, B_Off_0', 'BuildingTemplate, B_Res_0']
+"""
+import logging
+from collections import defaultdict
+
+from pymongo import ReplaceOne, UpdateOne
+
+from umitemplatedb import mongodb_schema
+from umitemplatedb.cache import document_cache
+from umitemplatedb.graph import fetch_graph, iter_references
+
+log = logging.getLogger(__name__)
+
+
+def _direct_references(document):
+    """Return the set of keys referenced by a Document."""
+    return {key for _, key, _ in iter_references(document.to_mongo())}
+
+
+def _update_template(key):
+    """Recompute the set of components reached by the template key."""
+    ReferenceIndex = mongodb_schema.ReferenceIndex
+
+    son = next(iter(document_cache.get_many([key])), None)
+    reachable = set()
+    if son is not None:
+        roots = {ref for _, ref, _ in iter_references(son)}
+        reachable = set(fetch_graph(roots, get_many=document_cache.get_many))
+    ReferenceIndex.objects(templates=key, key__nin=list(reachable)).update(
+        pull__templates=key
+    )
+    _add_to_set(reachable, "templates", key)
+
+
+def _add_to_set(keys, field, value):
+    """Add value to the field of the index entries of keys, in one round trip."""
+    requests = [
+        UpdateOne({"_id": key}, {"$addToSet": {field: value}}, upsert=True)
+        for key in keys
+    ]
+    if requests:
+        mongodb_schema.ReferenceIndex._get_collection().bulk_write(
+            requests, ordered=False
+        )
+
+
+def on_save(document):
+    """Update the index after document was saved."""
+    ReferenceIndex = mongodb_schema.ReferenceIndex
+
+    key = document.key
+    targets = _direct_references(document)
+    previous = set(ReferenceIndex.objects(referrers=key).scalar("key"))
+    removed, added = previous - targets, targets - previous
+    if removed:
+        ReferenceIndex.objects(key__in=list(removed)).update(pull__referrers=key)
+    _add_to_set(added, "referrers", key)
+    if isinstance(document, mongodb_schema.BuildingTemplate):
+        _update_template(key)
+    elif removed or added:
+        # The references changed: the templates reaching this component must
+        # recompute what they reach.
+        for template in templates_using(key):
+            _update_template(template)
+
+
+def on_delete(document):
+    """Update the index after document was deleted.
+
+    The entry of the deleted document is kept while other documents still
+    reference it, so that dangling references can be found.
+    """
+    ReferenceIndex = mongodb_schema.ReferenceIndex
+
+    key = document.key
+    ReferenceIndex.objects(referrers=key).update(pull__referrers=key)
+    if isinstance(document, mongodb_schema.BuildingTemplate):
+        ReferenceIndex.objects(templates=key).update(pull__templates=key)
+    else:
+        for template in templates_using(key):
+            _update_template(template)
+    ReferenceIndex.objects(key=key, referrers__size=0).delete()
+
+
+def referrers(key):
+    """Return the keys of the documents directly referencing key."""
+    entry = mongodb_schema.ReferenceIndex.objects(key=key).first()
+    return list(entry.referrers) if entry else []
+
+
+def templates_using(key):
+    """Return the keys of the BuildingTemplates reaching key."""
+    entry = mongodb_schema.ReferenceIndex.objects(key=key).first()
+    return list(entry.templates) if entry else []
+
+
+def impact(key):
+    """Return what is affected by a change of the component key.
+
+    Returns:
+        dict: "referrers", the documents referencing key directly, and
+            "templates", the BuildingTemplates reaching it. Cached data derived
+            from any of them should be invalidated.
+    """
+    entry = mongodb_schema.ReferenceIndex.objects(key=key).first()
+    if entry is None:
+        return {"referrers": [], "templates": []}
+    return {"referrers": list(entry.referrers), "templates": list(entry.templates)}
+
+
+def rebuild_index(batch_size=1000):
+    """Rebuild the whole reverse-reference index from the UmiBase collection.
+
+    The collection is scanned once; the templates reaching each component are
+    then computed in memory from the adjacency lists.
+
+    Args:
+        batch_size (int): Number of documents read and written per round trip.
+
+    Returns:
+        int: The number of index entries written.
+    """
+    ReferenceIndex = mongodb_schema.ReferenceIndex
+
+    adjacency, templates = {}, []
+    collection = mongodb_schema.UmiBase._get_collection()
+    for son in collection.find({}, batch_size=batch_size):
+        adjacency[son["_id"]] = {key for _, key, _ in iter_references(son)}
+        if son["_cls"].endswith(".BuildingTemplate"):
+            templates.append(son["_id"])
+
+    entries = defaultdict(lambda: {"referrers": set(), "templates": set()})
+    for key, targets in adjacency.items():
+        for target in targets:
+            entries[target]["referrers"].add(key)
+    for template in templates:
+        frontier, reached = set(adjacency[template]), set()
+        while frontier:
+            reached |= frontier
+            frontier = {
+                ref for key in frontier for ref in adjacency.get(key, ())
+            } - reached
+        for key in reached:
+            entries[key]["templates"].add(template)
+
+    ReferenceIndex.drop_collection()
+    ReferenceIndex.ensure_indexes()
+    requests = [
+        ReplaceOne(
+            {"_id": key},
+            {
+                "_id": key,
+                "referrers": sorted(entry["referrers"]),
+                "templates": sorted(entry["templates"]),
+            },
+            upsert=True,
+        )
+        for key, entry in entries.items()
+    ]
+    for i in range(0, len(requests), batch_size):
+        ReferenceIndex._get_collection().bulk_write(requests[i : i + batch_size])
+    log.info(f"rebuilt reference index with {len(requests)} entries")
+    return len(requests)
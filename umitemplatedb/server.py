@@ -0,0 +1,319 @@
+"""A small HTTP service serving templates from one pooled database connection.
+
+Endpoints (all GET):
+
+- `/templates?<filters>`: catalog of the BuildingTemplates matching the
+  filters, without their geometry. Filters use the mongoengine syntax, e.g.
+  `/templates?Country=FRA&YearFrom__gte=1980&Category__in=Office,Retail`.
+- `/templates/geo?lon=<lon>&lat=<lat>`: catalog of the templates whose
+  geometry contains the point.
+- `/facets?names=<facet>,...`: template counts per facet value, see
+  :func:`umitemplatedb.facets.facets`.
+- `/templates/<key>.json`: UMI Template File of one template.
+- `/export?<filters>`: UMI Template Files of the matching templates, streamed
+  as newline-delimited JSON (one library per template and per line).
+- `/changes?since=<token>&<filters>`: raw documents changed and deleted since
+  a sync token, see :func:`umitemplatedb.sync.changes_since`. Decode the
+  response with :func:`bson.json_util.loads` and apply it to a mirror with
+  :func:`umitemplatedb.sync.apply_changes`.
+
+Responses carry an ETag. Template exports are tagged with a hash of the raw
+documents of their reference graph, so a conditional GET (`If-None-Match`) is
+answered with 304 without converting the template. Serialized exports are kept
+in an LRU cache keyed on their ETag. The graphs are read through the
+:data:`~umitemplatedb.cache.document_cache`; the cached documents are checked
+against their DateModified on each request, so that writes of other processes
+(e.g. a scheduled import) are served at once.
+
+Example:
+    >>> from umitemplatedb.server import serve
+    >>> serve(port=8000, connect_kwargs={"db": "templatelibrary"})
+"""
+
+import hashlib
+import logging
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+from bson import json_util
+from mongoengine import ListField
+from mongoengine.errors import InvalidQueryError, ValidationError
+
+from umitemplatedb.cache import DocumentCache, document_cache
+from umitemplatedb.facets import facets
+from umitemplatedb.graph import fetch_graph, materialize, mongo_get_many
+from umitemplatedb.mongodb_schema import BuildingTemplate, UmiBase
+
+log = logging.getLogger(__name__)
+
+#: Fields of the catalog entries.
+CATALOG_FIELDS = (
+    "Name",
+    "Category",
+    "Country",
+    "ClimateZone",
+    "YearFrom",
+    "YearTo",
+    "Authors",
+    "Description",
+    "Version",
+    "DateModified",
+    "BoundingBox",
+)
+
+
+def parse_filters(params):
+    """Convert query-string parameters to mongoengine filters.
+
+    Values are converted with the BuildingTemplate field they apply to. The
+    `__in` and `__nin` operators take comma-separated values.
+
+    Args:
+        params (list of tuple): (name, value) pairs.
+
+    Returns:
+        dict: mongoengine keyword filters.
+    """
+    filters = {}
+    for name, value in params:
+        field_name, _, op = name.partition("__")
+        field = BuildingTemplate._fields.get(field_name)
+        if field is None:
+            raise ValueError(f"unknown field '{field_name}'")
+        if isinstance(field, ListField):
+            field = field.field
+        if op in ("in", "nin"):
+            filters[name] = [field.to_python(v) for v in value.split(",")]
+        else:
+            filters[name] = field.to_python(value)
+    return filters
+
+
+def catalog(query=None, **filters):
+    """Return the catalog entries of the templates matching filters."""
+    args = (query,) if query is not None else ()
+    raw_query = BuildingTemplate.objects(*args, **filters)._query
+    projection = dict.fromkeys(CATALOG_FIELDS, 1)
+    return [
+        dict(son, key=son.pop("_id"))
+        for son in UmiBase._get_collection().find(raw_query, projection)
+    ]
+
+
+def fresh_graph(keys):
+    """Fetch the graphs of keys through the document cache.
+
+    Cached documents modified or deleted since they were cached, e.g. by
+    another process, are reloaded. This costs one query of the DateModified
+    of the documents.
+
+    Returns:
+        dict: Raw documents keyed by their primary key.
+    """
+    docs = fetch_graph(keys, get_many=document_cache.get_many)
+    stamps = {
+        son["_id"]: son.get("DateModified")
+        for son in mongo_get_many(docs, {"DateModified": 1})
+    }
+    stale = [
+        k
+        for k, son in docs.items()
+        if k not in stamps or stamps[k] != son.get("DateModified")
+    ]
+    if stale:
+        document_cache.invalidate(*stale)
+        docs = fetch_graph(keys, get_many=document_cache.get_many)
+    return docs
+
+
+def template_etag(key, docs):
+    """Return the ETag of a template from the raw documents of its graph.
+
+    Args:
+        key (str): The key of the template.
+        docs (dict): Raw documents containing at least the graph of the
+            template. Documents not reachable from it are ignored.
+    """
+    graph = fetch_graph(
+        [key], get_many=lambda keys: [docs[k] for k in keys if k in docs]
+    )
+    digest = hashlib.sha1(key.encode())
+    for k in sorted(graph):
+        digest.update(json_util.dumps(graph[k], sort_keys=True).encode())
+    return f'"{digest.hexdigest()}"'
+
+
+def export_template(key, docs):
+    """Return the UMI Template File of a template as bytes."""
+    from umitemplatedb.core import _library
+
+    template = materialize(key, docs).to_template()
+    return _library([template], name=template.Name).to_json().encode()
+
+
+class TemplateRequestHandler(BaseHTTPRequestHandler):
+    """Request handler of :func:`make_server`."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        log.debug("%s - %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = unquote(url.path).rstrip("/")
+        try:
+            params = parse_qsl(url.query)
+            if path == "/templates":
+                self.send_json(catalog(**parse_filters(params)))
+            elif path == "/templates/geo":
+                params = dict(params)
+                point = {
+                    "type": "Point",
+                    "coordinates": [float(params["lon"]), float(params["lat"])],
+                }
+                self.send_json(catalog(**self.server.geo_filter(point)))
+            elif path == "/facets":
+                names = dict(params).get("names")
+                self.send_json(facets(*names.split(",") if names else ()))
+            elif path.startswith("/templates/") and path.endswith(".json"):
+                self.send_template(path[len("/templates/") : -len(".json")])
+            elif path == "/export":
+                self.send_export(parse_filters(params))
+            elif path == "/changes":
+                self.send_changes(params)
+            else:
+                self.send_error(HTTPStatus.NOT_FOUND)
+        except (ValueError, KeyError, InvalidQueryError, ValidationError) as e:
+            self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+        except NotImplementedError as e:
+            self.send_error(HTTPStatus.NOT_IMPLEMENTED, str(e))
+        except Exception:
+            log.exception(f"failed to serve {self.path}")
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    def send_body(self, body, etag, content_type="application/json"):
+        if etag in self.headers.get("If-None-Match", ""):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data):
+        body = json_util.dumps(data).encode()
+        self.send_body(body, f'"{hashlib.sha1(body).hexdigest()}"')
+
+    def send_template(self, key):
+        docs = fresh_graph([key])
+        if key not in docs:
+            self.send_error(HTTPStatus.NOT_FOUND, f"no template '{key}'")
+            return
+        etag = template_etag(key, docs)
+        if etag in self.headers.get("If-None-Match", ""):
+            self.send_body(b"", etag)
+            return
+        self.send_body(self.server.cached_export(key, docs, etag), etag)
+
+    def send_changes(self, params):
+        from umitemplatedb.sync import changes_since
+
+        since = dict(params).get("since")
+        filters = parse_filters([(k, v) for k, v in params if k != "since"])
+        self.send_json(changes_since(since, **filters))
+
+    def send_export(self, filters):
+        """Stream one UMI library per template, as newline-delimited JSON."""
+        keys = [entry["key"] for entry in catalog(**filters)]
+        docs = fresh_graph(keys)
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for key in keys:
+            body = self.server.cached_export(key, docs, template_etag(key, docs))
+            chunk = body.replace(b"\n", b"") + b"\n"
+            self.wfile.write(f"{len(chunk):X}\r\n".encode() + chunk + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class TemplateServer(ThreadingHTTPServer):
+    """Threaded HTTP server sharing one database connection and response cache.
+
+    Args:
+        server_address (tuple): (host, port).
+        response_cache_size (int): Number of serialized exports kept in memory.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, response_cache_size=256):
+        super(TemplateServer, self).__init__(server_address, TemplateRequestHandler)
+        self.responses = DocumentCache(maxsize=response_cache_size)
+
+    def cached_export(self, key, docs, etag):
+        """Return the export of key, from the response cache if possible."""
+        cached = self.responses.get_many([etag], loader=lambda etags: [])
+        if cached:
+            return cached[0]["body"]
+        body = export_template(key, docs)
+        self.responses.put_many([{"_id": etag, "body": body}])
+        return body
+
+    @staticmethod
+    def geo_filter(point):
+        """Return the filters selecting the templates containing point.
+
+        The point is matched against the shared country geometries first, then
+        against the explicit geometries of the templates.
+        """
+        from mongoengine import Q
+
+        from umitemplatedb.mongodb_schema import CountryGeometry
+
+        codes = CountryGeometry.objects(geometry__geo_intersects=point).scalar(
+            "ISO3_CODE"
+        )
+        return {
+            "query": Q(CountryGeometries__in=list(codes))
+            | Q(Polygon__geo_intersects=point)
+            | Q(MultiPolygon__geo_intersects=point)
+        }
+
+
+def make_server(host="127.0.0.1", port=8000, connect_kwargs=None, **kwargs):
+    """Create a :class:`TemplateServer`.
+
+    Args:
+        host (str): The interface to listen on.
+        port (int): The port to listen on. 0 picks a free port.
+        connect_kwargs (dict): If given, keyword arguments of
+            :func:`mongoengine.connect` used to open the pooled connection
+            (e.g. `{"db": "templatelibrary", "maxPoolSize": 50}`). Otherwise the
+            current default connection is used.
+        **kwargs: Passed to :class:`TemplateServer`.
+    """
+    if connect_kwargs is not None:
+        from mongoengine import connect
+
+        connect(**connect_kwargs)
+    return TemplateServer((host, port), **kwargs)
+
+
+def serve(host="127.0.0.1", port=8000, connect_kwargs=None, **kwargs):
+    """Serve templates until interrupted. See :func:`make_server`."""
+    server = make_server(host, port, connect_kwargs, **kwargs)
+    log.info(f"serving templates on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
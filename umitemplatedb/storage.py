@@ -0,0 +1,340 @@
+"""Storage backends for the documents of :mod:`umitemplatedb.mongodb_schema`.
+
+Two backends share the same interface:
+
+- :class:`MongoStore` uses the current mongoengine connection.
+- :class:`SQLiteStore` keeps the raw documents in a single SQLite file (one JSON
+  column per document). It needs no database server and can be opened
+  read-only, which makes it suited to desktop plugins and offline workers.
+
+Both store the raw documents exactly as MongoDB does (`_id`, `_cls` and the
+fields of the document), so documents can be copied from one backend to the
+other and :class:`BuildingTemplate` objects can be rebuilt from either one.
+
+Example:
+    >>> from umitemplatedb.storage import MongoStore, SQLiteStore
+    >>> with SQLiteStore("templates.db") as store:
+    ...     store.import_from(MongoStore(), Country="FRA")
+    ...     bldg = store.get_template("BuildingTemplate, B_Off_0")
+    ...     template = bldg.to_template()
+"""
+import logging
+import sqlite3
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+from bson import json_util
+from mongoengine import ListField
+
+from umitemplatedb.cache import document_cache
+from umitemplatedb.graph import fetch_graph, materialize
+from umitemplatedb.mongodb_schema import (
+    BuildingTemplate,
+    CountryGeometry,
+    StoreMeta,
+    Tombstone,
+    UmiBase,
+)
+
+log = logging.getLogger(__name__)
+
+
+class _Store(ABC):
+    """Methods common to all storage backends.
+
+    Backends implement the abstract methods.
+    """
+
+    @abstractmethod
+    def get_many(self, keys):
+        """Return the raw documents of keys. Missing keys are ignored."""
+
+    @abstractmethod
+    def put_many(self, sons):
+        """Insert or replace raw documents."""
+
+    @abstractmethod
+    def delete_many(self, keys):
+        """Delete the documents of keys. Missing keys are ignored."""
+
+    @abstractmethod
+    def get_meta(self, name, default=None):
+        """Return a value saved with :meth:`set_meta`, e.g. a sync token."""
+
+    @abstractmethod
+    def set_meta(self, name, value):
+        """Save a string value in the store."""
+
+    @abstractmethod
+    def find_templates(self, **filters):
+        """Return the raw BuildingTemplate documents matching filters."""
+
+    def country_geometry(self, code):
+        """Return the CountryGeometry of an ISO3 code, or None."""
+        return CountryGeometry.get(code)
+
+    def fetch_graph(self, keys):
+        """Return all raw documents reachable from keys, keyed by primary key."""
+        return fetch_graph(keys, get_many=self.get_many)
+
+    def get_template(self, key):
+        """Return a BuildingTemplate Document with all its references resolved.
+
+        The whole reference graph is fetched with one batched query per level.
+
+        Args:
+            key (str): The key of the BuildingTemplate.
+
+        Returns:
+            BuildingTemplate: The document. Call
+                :meth:`BuildingTemplate.to_template` to convert it.
+        """
+        docs = self.fetch_graph([key])
+        if key not in docs:
+            raise BuildingTemplate.DoesNotExist(f"No template with key '{key}'")
+        return materialize(key, docs)
+
+    def get_templates(self, **filters):
+        """Return the BuildingTemplate Documents matching filters.
+
+        Components shared by several templates are fetched and created once.
+        """
+        keys = [son["_id"] for son in self.find_templates(**filters)]
+        docs = self.fetch_graph(keys)
+        memo = {}
+        return [materialize(key, docs, memo) for key in keys]
+
+    def put(self, document):
+        """Validate and store a Document. Its key is set if needed.
+
+        Args:
+            document (UmiBase): The document. Referenced documents must already
+                have a key.
+        """
+        if isinstance(document, BuildingTemplate):
+            document.set_geometry(get_country=self.country_geometry)
+        document.key = document.make_key()
+        document.DateModified = datetime.utcnow()
+        if document.content_addressed:
+            document.merge_aliases(next(iter(self.get_many([document.key])), None))
+        document.validate()
+        self.put_many([document.to_mongo().to_dict()])
+        return document
+
+    def import_umitemplate(self, filename, **kwargs):
+        """Import an UMI Template File into this store.
+
+        Args:
+            filename (str or Path): The path of the UMI Template File.
+            **kwargs: keyword arguments added to the BuildingTemplate class.
+        """
+        from archetypal import UmiTemplateLibrary
+        from tqdm import tqdm
+
+        from umitemplatedb.core import to_document
+
+        lib = UmiTemplateLibrary.open(filename)
+        for bldgtemplate in tqdm(lib.BuildingTemplates, desc="importing templates"):
+            to_document(bldgtemplate, save=self.put, **kwargs)
+
+    def import_from(self, other, batch_size=1000, **filters):
+        """Copy the templates matching filters, and their components, from other.
+
+        Args:
+            other (_Store): The store to copy from.
+            batch_size (int): Number of documents written at once.
+            **filters: Filters on BuildingTemplate metadata. See
+                :meth:`find_templates`.
+
+        Returns:
+            int: The number of copied documents.
+        """
+        keys = [son["_id"] for son in other.find_templates(**filters)]
+        sons = list(other.fetch_graph(keys).values())
+        for i in range(0, len(sons), batch_size):
+            self.put_many(sons[i : i + batch_size])
+        return len(sons)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class MongoStore(_Store):
+    """Store backed by the current mongoengine connection.
+
+    Filters of :meth:`find_templates` are mongoengine filters, e.g.
+    `Country="FRA"` or `YearFrom__gte=1980`.
+    """
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return []
+        collection = UmiBase._get_collection()
+        return list(collection.find({"_id": {"$in": keys}}))
+
+    def put_many(self, sons):
+        from pymongo import ReplaceOne
+
+        keys = [son["_id"] for son in sons]
+        requests = [ReplaceOne({"_id": son["_id"]}, son, upsert=True) for son in sons]
+        if requests:
+            UmiBase._get_collection().bulk_write(requests, ordered=False)
+            document_cache.invalidate(*keys)
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        if keys:
+            UmiBase._get_collection().delete_many({"_id": {"$in": keys}})
+            Tombstone.record(keys)
+            document_cache.invalidate(*keys)
+
+    def get_meta(self, name, default=None):
+        meta = StoreMeta.objects(name=name).first()
+        return meta.value if meta else default
+
+    def set_meta(self, name, value):
+        StoreMeta(name=name, value=value).save()
+
+    def find_templates(self, **filters):
+        query = BuildingTemplate.objects(**filters)._query
+        return list(UmiBase._get_collection().find(query))
+
+
+_OPERATORS = {"gt": ">", "gte": ">=", "lt": "<", "lte": "<=", "ne": "!="}
+
+
+class SQLiteStore(_Store):
+    """Store backed by a single SQLite file.
+
+    Documents are kept in a `documents` table with a `key` primary key, the
+    class name in `cls` and the raw document as JSON in `doc`. Catalog queries
+    use the JSON1 functions of SQLite.
+
+    Filters of :meth:`find_templates` follow the mongoengine syntax for the
+    supported operators: equality, `__in`, `__ne`, `__gt`, `__gte`, `__lt` and
+    `__lte`. On list fields (e.g. `Country`, `ClimateZone`, `Authors`),
+    equality matches if the list contains the value.
+
+    Args:
+        path (str or Path): The database file. Use ":memory:" for a temporary
+            in-memory database.
+        readonly (bool): If True, the file is opened read-only and must exist.
+    """
+
+    def __init__(self, path, readonly=False):
+        self.path = str(path)
+        self.readonly = readonly
+        if readonly:
+            self.conn = sqlite3.connect(
+                f"file:{self.path}?mode=ro", uri=True, check_same_thread=False
+            )
+        else:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS documents (
+                    key TEXT PRIMARY KEY,
+                    cls TEXT NOT NULL,
+                    doc TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS documents_cls ON documents (cls);
+                CREATE TABLE IF NOT EXISTS meta (
+                    name TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                """
+            )
+
+    def country_geometry(self, code):
+        """Return None: country geometries are not stored in SQLite files.
+
+        Templates copied from MongoDB keep the code of their countries, their
+        bounding box and their footprint. Templates put directly in the file
+        have no geometry, so that the store never needs the network.
+        """
+        return None
+
+    def get_many(self, keys):
+        keys = list(keys)
+        sons = []
+        # Stay below the default limit of 999 variables per statement
+        for i in range(0, len(keys), 900):
+            chunk = keys[i : i + 900]
+            rows = self.conn.execute(
+                f"SELECT doc FROM documents WHERE key IN "
+                f"({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            sons.extend(json_util.loads(doc) for doc, in rows)
+        return sons
+
+    def put_many(self, sons):
+        rows = [
+            (son["_id"], son["_cls"].rsplit(".", 1)[-1], json_util.dumps(son))
+            for son in sons
+        ]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO documents (key, cls, doc) VALUES (?, ?, ?)",
+                rows,
+            )
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        with self.conn:
+            for i in range(0, len(keys), 900):
+                chunk = keys[i : i + 900]
+                self.conn.execute(
+                    f"DELETE FROM documents WHERE key IN "
+                    f"({', '.join('?' * len(chunk))})",
+                    chunk,
+                )
+
+    def get_meta(self, name, default=None):
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, name, value):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                (name, value),
+            )
+
+    def find_templates(self, **filters):
+        clauses, params = ["cls = ?"], ["BuildingTemplate"]
+        for name, value in filters.items():
+            field_name, _, op = name.partition("__")
+            field = BuildingTemplate._fields.get(field_name)
+            if field is None or op not in ("", "in", *_OPERATORS):
+                raise ValueError(f"unsupported filter '{name}'")
+            path = f"'$.{field.db_field}'"
+            values = list(value) if op == "in" else [value]
+            if isinstance(field, ListField) and op in ("", "in"):
+                clauses.append(
+                    f"EXISTS (SELECT 1 FROM json_each(doc, {path}) WHERE value IN "
+                    f"({', '.join('?' * len(values))}))"
+                )
+            elif op in ("", "in"):
+                clauses.append(
+                    f"json_extract(doc, {path}) IN ({', '.join('?' * len(values))})"
+                )
+            else:
+                clauses.append(f"json_extract(doc, {path}) {_OPERATORS[op]} ?")
+            params.extend(values)
+        rows = self.conn.execute(
+            f"SELECT doc FROM documents WHERE {' AND '.join(clauses)}", params
+        )
+        return [json_util.loads(doc) for doc, in rows]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,178 @@
+"""Incremental synchronization of local mirrors.
+
+:meth:`UmiBase.save` stamps every document with its `DateModified` (indexed)
+and :meth:`UmiBase.delete` leaves a
+:class:`~umitemplatedb.mongodb_schema.Tombstone`. :func:`changes_since` returns
+the documents changed and deleted since a sync token, and
+:func:`apply_changes` applies them to a store, so that refreshing a mirror
+costs in proportion to what changed instead of to the size of the database.
+
+Tokens are opaque strings returned with each set of changes. The changes
+returned for a token start a little before the end of the previous ones (see
+:data:`SYNC_LAG`) so that writes in flight at the time of a sync are not
+missed; applying the same change twice is harmless.
+
+Example:
+    >>> from umitemplatedb.storage import SQLiteStore
+    >>> from umitemplatedb.sync import sync
+    >>> with SQLiteStore("mirror.db") as mirror:
+    ...     changes = sync(mirror, Country="FRA")  # full copy the first time
+    ...     changes = sync(mirror, Country="FRA")  # then only the changes
+"""
+import logging
+from datetime import datetime, timedelta
+
+log = logging.getLogger(__name__)
+
+#: Overlap between two consecutive syncs, covering writes in flight and
+#: clock differences between the writers.
+SYNC_LAG = timedelta(seconds=5)
+
+#: Key under which stores keep their sync token.
+TOKEN_KEY = "sync_token"
+
+
+def parse_token(token):
+    """Return the time of a sync token, or None for a full sync.
+
+    Args:
+        token (str or datetime): A token returned by :func:`changes_since`, an
+            ISO 8601 timestamp in UTC, a datetime, or None.
+    """
+    if token is None or isinstance(token, datetime):
+        return token
+    try:
+        return datetime.fromisoformat(token)
+    except ValueError:
+        raise ValueError(f"invalid sync token '{token}'")
+
+
+def changes_since(token=None, lag=SYNC_LAG, **filters):
+    """Return the changes of the database since token.
+
+    Without filters, the changes are all the documents modified since token.
+    With filters, they are restricted to the BuildingTemplates matching the
+    filters: a modified template comes with its whole reference graph (it may
+    be new to the mirror), and a modified component is returned if a matching
+    template uses it. Templates modified to no longer match are returned as
+    deleted.
+
+    Args:
+        token (str): The token of the previous changes, or None for all the
+            documents.
+        lag (timedelta): Overlap with the previous changes.
+        **filters: mongoengine keyword filters on BuildingTemplate.
+
+    Returns:
+        dict: "token", the token of the next call; "templates", the keys of the
+            modified BuildingTemplates; "documents", the raw documents to insert
+            or replace; "deleted", the keys of the documents to delete.
+    """
+    from umitemplatedb.graph import fetch_graph, mongo_get_many
+    from umitemplatedb.mongodb_schema import (
+        BuildingTemplate,
+        ReferenceIndex,
+        Tombstone,
+        UmiBase,
+    )
+
+    since = parse_token(token)
+    next_token = (datetime.utcnow() - lag).isoformat()
+    collection = UmiBase._get_collection()
+    modified = {} if since is None else {"DateModified": {"$gte": since}}
+
+    deleted = []
+    if since is not None:
+        tombstones = Tombstone.objects(DateDeleted__gte=since).scalar("key")
+        deleted = list(tombstones)
+        # Keys saved again after their deletion are not deleted
+        alive = {son["_id"] for son in collection.find({"_id": {"$in": deleted}}, {})}
+        deleted = [key for key in deleted if key not in alive]
+
+    template_query = BuildingTemplate.objects(**modified)._query
+    if not filters:
+        templates = [son["_id"] for son in collection.find(template_query, {})]
+        documents = list(collection.find(modified))
+    else:
+        matching = set(BuildingTemplate.objects(**filters).scalar("key"))
+        templates = []
+        for son in collection.find(template_query, {}):
+            if son["_id"] in matching:
+                templates.append(son["_id"])
+            elif since is not None:
+                deleted.append(son["_id"])
+        docs = fetch_graph(templates)
+        if since is not None:
+            components = {
+                son["_id"]
+                for son in collection.find(
+                    dict(modified, _cls={"$ne": BuildingTemplate._class_name}),
+                    {},
+                )
+            }
+            used = ReferenceIndex.objects(
+                key__in=list(components - set(docs)), templates__in=list(matching)
+            ).scalar("key")
+            docs.update((son["_id"], son) for son in mongo_get_many(used))
+        documents = list(docs.values())
+    log.info(
+        f"{len(documents)} documents modified and {len(deleted)} deleted since "
+        f"{since or 'the beginning'}"
+    )
+    return {
+        "token": next_token,
+        "templates": templates,
+        "documents": documents,
+        "deleted": deleted,
+    }
+
+
+def apply_changes(store, changes, batch_size=1000):
+    """Apply changes returned by :func:`changes_since` to a store.
+
+    The token of the changes is saved in the store.
+
+    Args:
+        store (umitemplatedb.storage._Store): The mirror.
+        changes (dict): The changes.
+        batch_size (int): Number of documents written at once.
+    """
+    documents = changes["documents"]
+    for i in range(0, len(documents), batch_size):
+        store.put_many(documents[i : i + batch_size])
+    store.delete_many(changes["deleted"])
+    store.set_meta(TOKEN_KEY, changes["token"])
+
+
+def sync(store, lag=SYNC_LAG, **filters):
+    """Bring a mirror up to date with the database of the current connection.
+
+    The first sync of a store copies all the (matching) documents; the next
+    ones copy only what changed since the previous one.
+
+    Args:
+        store (umitemplatedb.storage._Store): The mirror.
+        lag (timedelta): Overlap with the previous sync.
+        **filters: mongoengine keyword filters on BuildingTemplate. Use the same
+            filters for every sync of a mirror.
+
+    Returns:
+        dict: The applied changes. See :func:`changes_since`.
+    """
+    changes = changes_since(store.get_meta(TOKEN_KEY), lag=lag, **filters)
+    apply_changes(store, changes)
+    return changes
+
+
+def purge_tombstones(before):
+    """Delete the tombstones older than before.
+
+    Mirrors last synchronized before that time miss the deletions: they must
+    be rebuilt with a full sync (a None token).
+
+    Returns:
+        int: The number of deleted tombstones.
+    """
+    from umitemplatedb.mongodb_schema import Tombstone
+
+    return Tombstone.objects(DateDeleted__lt=before).delete()